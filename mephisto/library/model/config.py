@@ -7,6 +7,25 @@ from kayaku import config
 class MephistoNetworkConfig:
     proxy: str = ""
     timeout: int = 30
+    download_concurrency: int = 16
+    download_host_concurrency: int = 4
+
+
+@dataclass
+class MephistoDatabaseConfig:
+    layout: str = "scene"
+    shards: int = 16
+    mysql_url: str = ""
+    profile: str = "balanced"
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    cache_size: int = -8000
+    mmap_size: int = 67108864
+    temp_store: str = "MEMORY"
+    busy_timeout: int = 5000
+    readers: int = 4
+    max_open: int = 256
+    idle_timeout: int = 600
 
 
 @dataclass
@@ -14,11 +33,20 @@ class MephistoAdvancedConfig:
     debug: bool = False
     log_rotate: int = 7
     message_cache_size: int = 5000
+    message_cache_scenes: int = 64
     uvicorn_port: int = 8000
     domain: str = "localhost"
     show_port: bool = False
     use_https: bool = False
     pdm_path: str = "pdm"
+    record_buffer_size: int = 100
+    record_flush_interval: float = 1.0
+    record_reencode: bool = True
+    attachment_gc_interval: int = 3600
+    attachment_gc_grace: int = 86400
+    attachment_tier_days: int = 30
+    attachment_pack_size: int = 268435456
+    database: MephistoDatabaseConfig = field(default_factory=MephistoDatabaseConfig)
 
 
 @config("library.main")
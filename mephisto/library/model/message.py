@@ -1,12 +1,15 @@
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Self
 
-from avilla.core import Selector
+from avilla.core import Message, Selector
 from creart import it
 from graia.amnesia.message.chain import MessageChain
+from kayaku import create
 from launart import Launart
 
+from mephisto.library.model.config import MephistoConfig
 from mephisto.library.model.exception import MessageRecordNotFound
 from mephisto.library.service import DataService
 from mephisto.library.util.message.deserialize import deserialize
@@ -27,17 +30,65 @@ class RebuiltMessage:
     edited: bool
     edit_time: datetime | None
 
+    @classmethod
+    def from_message(cls, message: Message) -> Self:
+        return cls(
+            scene=message.scene,
+            client=message.sender,
+            selector=message.to_selector(),
+            time=message.time,
+            content=message.content,
+            reply_to=message.reply,
+            deleted=False,
+            delete_time=None,
+            edited=False,
+            edit_time=None,
+        )
+
+    @classmethod
+    def remember(cls, message: "RebuiltMessage"):
+        """
+        Keep a message in the per-scene cache, evicting the least recently used.
+
+        Only the most recently active scenes keep a cache, so that the total
+        is bounded no matter how many scenes were seen.
+        """
+        cfg = create(MephistoConfig).advanced
+        cache = _cache.setdefault(message.scene.display, OrderedDict())
+        _cache.move_to_end(message.scene.display)
+        cache[message.selector.display] = message
+        cache.move_to_end(message.selector.display)
+        while len(cache) > cfg.message_cache_size:
+            cache.popitem(last=False)
+        while len(_cache) > cfg.message_cache_scenes:
+            _cache.popitem(last=False)
+
+    @classmethod
+    def forget(cls, selector: Selector, scene: Selector):
+        if (cache := _cache.get(scene.display)) is None:
+            return
+        cache.pop(selector.display, None)
+        if not cache:
+            del _cache[scene.display]
+
     @classmethod
     async def from_selector(cls, selector: Selector, scene: Selector) -> Self:
-        registry = it(Launart).get_component(DataService).registry
-        engine = await registry.create(scene)
+        if (cache := _cache.get(scene.display)) and (
+            cached := cache.get(selector.display)
+        ):
+            _cache.move_to_end(scene.display)
+            cache.move_to_end(selector.display)
+            return cached  # type: ignore
+        data = it(Launart).get_component(DataService)
+        await data.buffer.flush(scene)
+        engine = await data.registry.create(scene)
         async with engine.scalar(
             RecordTable, RecordTable.selector == selector.display
         ) as result:
             if not result:
                 raise MessageRecordNotFound(selector, scene)
 
-            return cls(
+            rebuilt = cls(
                 scene=Selector.from_follows(str(result.scene)),
                 client=Selector.from_follows(str(result.client)),  # type: ignore
                 selector=Selector.from_follows(str(result.selector)),
@@ -53,3 +104,9 @@ class RebuiltMessage:
                 edited=result.edited,  # type: ignore
                 edit_time=result.edit_time,  # type: ignore
             )
+        cls.remember(rebuilt)
+        return rebuilt
+
+
+# Recently recorded or rebuilt messages, by scene and message selector display
+_cache: OrderedDict[str, OrderedDict[str, RebuiltMessage]] = OrderedDict()
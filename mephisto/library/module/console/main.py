@@ -5,10 +5,14 @@ from avilla.core import BaseAccount, Context, Selector
 from avilla.standard.core.account import AccountAvailable
 from avilla.standard.core.message import MessageReceived
 from avilla.twilight.twilight import FullMatch, Twilight
+from creart import it
 from graia.broadcast import PropagationCancelled
 from graia.saya.builtins.broadcast.shortcut import dispatch, listen
+from launart import Launart
 
+from mephisto.library.service import DataService
 from mephisto.library.util.decorator import include
+from mephisto.library.util.orm.migrate import import_scene_databases
 
 _HELLO_TEXT = """
 # Mephisto
@@ -47,3 +51,25 @@ async def console_help(ctx: Context):
 @dispatch(Twilight(FullMatch("/stop")))
 async def console_stop():
     signal.raise_signal(signal.SIGINT)
+
+
+@listen(MessageReceived)
+@include("console")
+@dispatch(Twilight(FullMatch("/database"), FullMatch("import")))
+async def console_database_import(ctx: Context):
+    registry = it(Launart).get_component(DataService).registry
+    await ctx.scene.send_message("Importing per-scene databases...")
+    count = await import_scene_databases(registry)
+    await ctx.scene.send_message(f"Imported {count} records")
+    raise PropagationCancelled()
+
+
+@listen(MessageReceived)
+@include("console")
+@dispatch(Twilight(FullMatch("/database"), FullMatch("reencode")))
+async def console_database_reencode(ctx: Context):
+    data = it(Launart).get_component(DataService)
+    await ctx.scene.send_message("Re-encoding legacy records...")
+    count = await data.reencode_records(pause=0, force=True)
+    await ctx.scene.send_message(f"Re-encoded {count} records")
+    raise PropagationCancelled()
@@ -1,5 +1,10 @@
+import asyncio
 import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from http import HTTPStatus
+from typing import Any, Final
 from urllib.parse import unquote
 
 import filetype
@@ -19,6 +24,7 @@ from graiax.fastapi.saya.route import get
 from launart import Launart
 
 from mephisto import __version__
+from mephisto.library.model.message import RebuiltMessage
 from mephisto.library.service import DataService
 from mephisto.library.service.module import ModuleStore
 from mephisto.library.util.const import (
@@ -40,61 +46,127 @@ async def ignore_self_message(ctx: Context):
         raise PropagationCancelled()
 
 
-@listen(MessageReceived, MessageSent)
-@priority(-1)
-async def record_received(avilla: Avilla, ctx: Context, message: Message):
-    registry = avilla.launch_manager.get_component(DataService).registry
-    engine = await registry.create(message.scene)
+RECENT_RECORD_SIZE: Final[int] = 256
+RECENT_RECORD_TTL: Final[float] = 60.0
+
+
+@dataclass
+class _RecentRecord:
+    expire: float
+    prepared: asyncio.Task[dict[str, Any]]
+    values: dict[str, Any] = field(default_factory=dict)
+
+
+# Messages sent by the bot are often echoed back by the protocol as well
+_recent: OrderedDict[str, _RecentRecord] = OrderedDict()
+
+
+async def _prepare_record(ctx: Context, message: Message) -> dict[str, Any]:
     await save_resources(ctx, message.content)
+    RebuiltMessage.remember(RebuiltMessage.from_message(message))
     resources = extract_resources(message.content)
-    content = serialize(message.content)
-    await engine.insert_or_update(
-        RecordTable,
-        RecordTable.message_id == message.id,
-        message_id=message.id,
-        scene=message.scene.display,
-        client=message.sender.display,
-        selector=message.to_selector().display,
-        time=message.time,
-        content=content,
-        attachments=json.dumps(
+    return {
+        "content": serialize(message.content),
+        "attachments": json.dumps(
             {k: v.to_selector().display for k, _, v in resources}, ensure_ascii=False
         ),
-        reply_to=message.reply.display if message.reply else None,
+    }
+
+
+def _recent_record(ctx: Context, message: Message, selector: str) -> _RecentRecord:
+    now = time.monotonic()
+    if (record := _recent.get(selector)) is not None and record.expire > now:
+        _recent.move_to_end(selector)
+        return record
+    record = _recent[selector] = _RecentRecord(
+        now + RECENT_RECORD_TTL, asyncio.create_task(_prepare_record(ctx, message))
+    )
+    _recent.move_to_end(selector)
+    while len(_recent) > RECENT_RECORD_SIZE:
+        _recent.popitem(last=False)
+    return record
+
+
+@listen(MessageReceived, MessageSent)
+@priority(-1)
+async def record_received(avilla: Avilla, ctx: Context, message: Message):
+    data = avilla.launch_manager.get_component(DataService)
+    selector = message.to_selector().display
+    record = _recent_record(ctx, message, selector)
+    try:
+        prepared = await asyncio.shield(record.prepared)
+    except Exception:
+        if _recent.get(selector) is record:
+            del _recent[selector]
+        raise
+    values = {
+        "message_id": message.id,
+        "scene": message.scene.display,
+        "client": message.sender.display,
+        "time": message.time,
+        **prepared,
+        "reply_to": message.reply.display if message.reply else None,
+    }
+    if not (
+        changed := {
+            k: v
+            for k, v in values.items()
+            if k not in record.values or record.values[k] != v
+        }
+    ):
+        return
+    record.values.update(changed)
+    data.buffer.put(
+        message.scene, RecordTable, ("selector",), selector=selector, **changed
     )
 
 
 @listen(MessageEdited)
 @priority(-1)
 async def record_edited(avilla: Avilla, ctx: Context, message: Message):
-    registry = avilla.launch_manager.get_component(DataService).registry
-    engine = await registry.create(message.scene)
+    data = avilla.launch_manager.get_component(DataService)
+    selector = message.to_selector().display
+    _recent.pop(selector, None)
     await save_resources(ctx, message.content)
     resources = extract_resources(message.content)
     content = serialize(message.content)
-    await engine.update(
-        RecordTable,
-        RecordTable.message_id == message.id,
-        message_id=message.id,
-        scene=message.scene.display,
-        client=message.sender.display,
-        selector=message.to_selector().display,
-        time=message.time,
-        content=content,
-        attachments=json.dumps(
-            {k: v.to_selector().display for k, _, v in resources}, ensure_ascii=False
-        ),
-        reply_to=message.reply.display if message.reply else None,
-        edited=True,
-        edit_time=message.time,
-    )
+    # Saving resources may take long, during which the engine may be disposed
+    await data.buffer.flush(message.scene)
+    engine = await data.registry.create(message.scene)
+    async with engine.transaction() as tx:
+        previous = await tx.scalar(RecordTable, RecordTable.selector == selector)
+        await tx.upsert(
+            RecordTable,
+            RecordTable.selector == selector,
+            message_id=message.id,
+            scene=message.scene.display,
+            client=message.sender.display,
+            selector=selector,
+            time=message.time,
+            content=content,
+            attachments=json.dumps(
+                {k: v.to_selector().display for k, _, v in resources},
+                ensure_ascii=False,
+            ),
+            reply_to=message.reply.display if message.reply else None,
+            edited=True,
+            edit_time=message.time,
+        )
+    RebuiltMessage.forget(message.to_selector(), message.scene)
+    if previous is not None and previous.attachments:
+        displays = json.loads(str(previous.attachments)).values()
+        await data.attachments.release(
+            *(digest for digest in map(data.attachments.digest_of, displays) if digest)
+        )
 
 
 @listen(MessageRevoked)
 @priority(-1)
 async def record_revoked(avilla: Avilla, ctx: Context, event: MessageRevoked):
-    registry = avilla.launch_manager.get_component(DataService).registry
-    engine = await registry.create(ctx.scene)
+    data = avilla.launch_manager.get_component(DataService)
+    _recent.pop(event.message.to_selector().display, None)
+    await data.buffer.flush(ctx.scene)
+    engine = await data.registry.create(ctx.scene)
     await engine.insert_or_update(
         RecordTable,
         RecordTable.selector == event.message.to_selector().display,
@@ -105,6 +177,7 @@ async def record_revoked(avilla: Avilla, ctx: Context, event: MessageRevoked):
         deleted=True,
         delete_time=event.time,
     )
+    RebuiltMessage.forget(event.message.to_selector(), ctx.scene)
 
 
 @get("/core/service/version")
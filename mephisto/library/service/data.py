@@ -1,10 +1,19 @@
+import asyncio
+from contextlib import suppress
+from datetime import datetime
+
 import kayaku
+from kayaku import create
 from launart import Launart, Service
 from launart.status import Phase
 from loguru import logger
 
+from mephisto.library.model.config import MephistoConfig
+from mephisto.library.util.attachment import AttachmentStore
 from mephisto.library.util.const import TEMPORARY_FILES_ROOT
 from mephisto.library.util.orm.base import DatabaseEngine
+from mephisto.library.util.orm.buffer import WriteBuffer
+from mephisto.library.util.orm.migrate import REENCODE_MARKER, reencode_records
 from mephisto.library.util.orm.registry import DatabaseRegistry
 from mephisto.library.util.orm.table import (
     AttachmentTable,
@@ -12,6 +21,7 @@ from mephisto.library.util.orm.table import (
     ConfigTable,
     PermissionTable,
     RecordTable,
+    SchemaTable,
     StatisticsTable,
 )
 
@@ -19,6 +29,8 @@ from mephisto.library.util.orm.table import (
 class DataService(Service):
     id = "mephisto.service/data"
     registry: DatabaseRegistry
+    buffer: WriteBuffer
+    attachments: AttachmentStore
 
     @property
     def required(self):
@@ -31,6 +43,65 @@ class DataService(Service):
     async def get_main_engine(self):
         return await self.registry.create("main")
 
+    async def sweep_databases(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.registry.sweep()
+            except Exception as err:
+                logger.exception(err)
+                logger.error("[DataService] Failed to sweep idle databases")
+
+    async def maintain_attachments(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            cfg = create(MephistoConfig).advanced
+            try:
+                await self.attachments.collect(cfg.attachment_gc_grace)
+            except Exception as err:
+                logger.exception(err)
+                logger.error("[DataService] Failed to collect unreferenced attachments")
+            if cfg.attachment_tier_days <= 0:
+                continue
+            try:
+                await self.attachments.tier(
+                    cfg.attachment_tier_days * 86400, cfg.attachment_pack_size
+                )
+            except Exception as err:
+                logger.exception(err)
+                logger.error("[DataService] Failed to pack cold attachments")
+
+    async def reencode_records(self, pause: float = 0.1, force: bool = False) -> int:
+        from mephisto.library.util.message.deserialize import reencode
+        from mephisto.library.util.message.serialize import COMPACT_PREFIX
+
+        main_engine = await self.registry.create("main")
+        if not force and await main_engine.first(
+            SchemaTable, SchemaTable.hook == REENCODE_MARKER
+        ):
+            return 0
+        try:
+            count = await reencode_records(
+                self.registry,
+                reencode,
+                RecordTable.content.not_like(f"{COMPACT_PREFIX}%"),
+                pause=pause,
+            )
+            await main_engine.insert_or_update(
+                SchemaTable,
+                SchemaTable.hook == REENCODE_MARKER,
+                hook=REENCODE_MARKER,
+                version=1,
+                apply_time=datetime.now(),
+            )
+        except Exception as err:
+            logger.exception(err)
+            logger.error("[DataService] Failed to re-encode records")
+            return 0
+        if count:
+            logger.success(f"[DataService] Re-encoded {count} records")
+        return count
+
     @staticmethod
     def ensure_temp():
         if not TEMPORARY_FILES_ROOT.is_dir():
@@ -44,6 +115,7 @@ class DataService(Service):
 
     async def launch(self, manager: Launart):
         self.registry = DatabaseRegistry()
+        self.attachments = AttachmentStore(self.registry)
 
         async with self.stage("preparing"):
             self.ensure_temp()
@@ -52,26 +124,70 @@ class DataService(Service):
             kayaku.save_all()
             logger.success("[DataService] Initialized all configurations")
 
-            main_engine = await self.registry.create("main")
+            cfg: MephistoConfig = create(MephistoConfig)
+            self.buffer = WriteBuffer(
+                self.registry,
+                cfg.advanced.record_buffer_size,
+                cfg.advanced.record_flush_interval,
+            )
+
+            main_engine = await self.registry.create("main", pin=True)
             await main_engine.create(ConfigTable)
             await main_engine.create(AttachmentTable)
             await main_engine.create(StatisticsTable)
             await main_engine.create(CacheTable)
             await main_engine.create(PermissionTable)
+            await main_engine.create(SchemaTable)
+            await self.attachments.warm()
 
             logger.success("[DataService] Initialized main database")
 
-            @self.registry.hook
+            @self.registry.hook(version=1)
             async def create_all(engine: DatabaseEngine):
                 await engine.create(RecordTable)
-                await engine.create(ConfigTable)
+                # Config has no scene column, so scenes sharing a database in
+                # the other layouts would share their config as well
+                if self.registry.layout() == "scene":
+                    await engine.create(ConfigTable)
                 await engine.create(StatisticsTable)
 
+            try:
+                await self.attachments.backfill()
+            except Exception as err:
+                logger.exception(err)
+                logger.error("[DataService] Failed to count attachment references")
+
+        async with self.stage("blocking"):
+            tasks = [
+                asyncio.create_task(
+                    self.maintain_attachments(cfg.advanced.attachment_gc_interval)
+                ),
+            ]
+            # An idle timeout of 0 disables sweeping idle databases
+            if (idle_timeout := cfg.advanced.database.idle_timeout) > 0:
+                tasks.append(
+                    asyncio.create_task(
+                        self.sweep_databases(max(min(idle_timeout, 60), 1))
+                    )
+                )
+            if cfg.advanced.record_reencode:
+                tasks.append(asyncio.create_task(self.reencode_records()))
+            await manager.status.wait_for_sigexit()
+            for task in tasks:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+
         async with self.stage("cleanup"):
             kayaku.save_all()
             logger.success("[DataService] Saved all configurations")
 
-            for db_name, database in self.registry.databases.items():
+            await self.buffer.close()
+            logger.success("[DataService] Flushed all pending writes")
+
+            self.attachments.close()
+
+            for db_name, database in list(self.registry.databases.items()):
                 logger.debug(f"[DataService] Closing database {db_name}")
                 await database.close()
 
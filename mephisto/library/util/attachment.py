@@ -0,0 +1,468 @@
+import asyncio
+import json
+import mimetypes
+import os
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Final
+from uuid import uuid4
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from avilla.core import Selector
+from loguru import logger
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from mephisto.library.util.const import ATTACHMENT_ROOT
+from mephisto.library.util.orm.migrate import record_databases
+from mephisto.library.util.orm.registry import DatabaseRegistry
+from mephisto.library.util.orm.table import AttachmentTable, RecordTable, SchemaTable
+
+PACK_DIRECTORY: Final[str] = "packs"
+REFCOUNT_MARKER: Final[str] = "mephisto.attachment.refcount"
+STORED_MIME_PREFIXES: Final[tuple[str, ...]] = ("image/", "video/", "audio/")
+
+
+@dataclass
+class StoredAttachment:
+    path: Path
+    mime: str | None
+    pack: Path | None = None
+
+
+class AttachmentStore:
+    """
+    Content-addressed attachment blobs, indexed in the main database.
+
+    Blobs live at `<root>/<digest[:2]>/<digest[2:4]>/<digest>[.ext]` and are
+    written once; every reference to a blob increments its reference count,
+    and blobs no longer referenced are reclaimed by `collect()`. Paths and mime
+    types are kept in an in-memory index warmed by `warm()`, so resolving a
+    digest does not touch the database or walk directories. Blobs not accessed
+    for a while are moved into zip packs under `<root>/packs` by `tier()`, and
+    served from there transparently.
+    """
+
+    registry: DatabaseRegistry
+    root: Path
+    index: dict[str, StoredAttachment]
+    accessed: set[str]
+    counted: bool
+
+    def __init__(self, registry: DatabaseRegistry, root: Path = ATTACHMENT_ROOT):
+        self.registry = registry
+        self.root = root
+        self.index = {}
+        self.accessed = set()
+        self.counted = False
+        self._packs: dict[Path, ZipFile] = {}
+
+    def _stored(self, row) -> StoredAttachment:
+        return StoredAttachment(
+            self.root / str(row.file_path),
+            row.mime,
+            self.root / str(row.pack) if row.pack else None,
+        )
+
+    async def warm(self, batch_size: int = 1000):
+        """Load the path and mime type of every indexed blob into memory"""
+        engine = await self.registry.create("main")
+        async for rows in engine.paginate(
+            AttachmentTable, AttachmentTable.digest.is_not(None), batch_size=batch_size
+        ):
+            for row in rows:
+                self.index[str(row.digest)] = self._stored(row)
+        logger.success(f"[AttachmentStore] Indexed {len(self.index)} blobs")
+
+    async def backfill(self, batch_size: int = 1000):
+        """
+        Recount the references to every blob from the stored records, once.
+
+        Blobs saved before reference counting have no row, or a count missing
+        the records that came before it, so releasing a reference could reclaim
+        a blob still in use. `collect()` stays disabled until this has run.
+        Must not run while messages are being recorded.
+        """
+        engine = await self.registry.create("main")
+        if await engine.first(SchemaTable, SchemaTable.hook == REFCOUNT_MARKER):
+            self.counted = True
+            return
+        counts: Counter[str] = Counter()
+        async for name, database in record_databases(self.registry):
+            async for rows in database.paginate(
+                RecordTable, RecordTable.attachments.is_not(None), batch_size=batch_size
+            ):
+                for row in rows:
+                    try:
+                        displays = json.loads(str(row.attachments)).values()
+                    except (ValueError, AttributeError):
+                        continue
+                    counts.update(filter(None, map(self.digest_of, displays)))
+            logger.debug(f"[AttachmentStore] Counted references in {name}")
+        existing: set[str] = set()
+        async for rows in engine.paginate(
+            AttachmentTable, AttachmentTable.digest.is_not(None), batch_size=batch_size
+        ):
+            existing.update(str(row.digest) for row in rows)
+        now = datetime.now()
+        missing = []
+        for digest in counts.keys() - existing:
+            path = await asyncio.to_thread(self._glob, digest) or self.path(digest)
+            missing.append(
+                {
+                    "pattern": self.selector(digest).display,
+                    "file_path": path.relative_to(self.root).as_posix(),
+                    "digest": digest,
+                    "mime": mimetypes.guess_type(path.name)[0],
+                    "refcount": counts[digest],
+                    "create_time": now,
+                    "deleted": False,
+                }
+            )
+        async with engine.begin():
+            await engine.update_many(
+                AttachmentTable,
+                [
+                    (
+                        {
+                            "digest": digest,
+                            "refcount": counts[digest],
+                            "deleted": False,
+                            "delete_time": None,
+                        }
+                        if digest in counts
+                        else {"digest": digest, "refcount": 0}
+                    )
+                    for digest in existing
+                ],
+                ("digest",),
+            )
+            await engine.insert_many(AttachmentTable, missing)
+            await engine.insert(
+                SchemaTable, hook=REFCOUNT_MARKER, version=1, apply_time=now
+            )
+        self.counted = True
+        logger.success(
+            f"[AttachmentStore] Counted references to {len(counts)} blobs, "
+            f"{len(missing)} of them newly indexed"
+        )
+
+    @staticmethod
+    def selector(digest: str) -> Selector:
+        return Selector().land("mephisto-attachment").digest(digest)
+
+    @staticmethod
+    def digest_of(display: str) -> str | None:
+        """Extract the digest from the selector display of a stored attachment"""
+        pattern = Selector.from_follows(display).pattern
+        if pattern.get("land") != "mephisto-attachment":
+            return None
+        return pattern.get("digest")
+
+    def path(self, digest: str, extension: str | None = None) -> Path:
+        path = self.root / digest[:2] / digest[2:4] / digest
+        return path.with_suffix(f".{extension}") if extension else path
+
+    def _glob(self, digest: str) -> Path | None:
+        return next(self.path(digest).parent.glob(f"{digest}*"), None)
+
+    @staticmethod
+    def _size(path: Path) -> int | None:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return None
+
+    async def locate(self, digest: str) -> StoredAttachment | None:
+        """Return where a stored blob lives, or None if missing"""
+        if digest in self.index:
+            return self.index[digest]
+        engine = await self.registry.create("main")
+        if row := await engine.scalar_eager(
+            AttachmentTable, AttachmentTable.digest == digest
+        ):
+            stored = self._stored(row)
+            if await asyncio.to_thread((stored.pack or stored.path).is_file):
+                self.index[digest] = stored
+                return stored
+        if path := await asyncio.to_thread(self._glob, digest):
+            self.index[digest] = StoredAttachment(
+                path, mimetypes.guess_type(path.name)[0]
+            )
+            return self.index[digest]
+        return None
+
+    async def find(self, digest: str) -> Path | None:
+        """Return the path of a stored blob or of the pack holding it, or None"""
+        if not (stored := await self.locate(digest)):
+            return None
+        return stored.pack or stored.path
+
+    def _read_packed(self, pack: Path, digest: str) -> bytes:
+        if (archive := self._packs.get(pack)) is None:
+            archive = self._packs[pack] = ZipFile(pack)
+        return archive.read(digest)
+
+    async def read(self, digest: str) -> bytes | None:
+        """Read a stored blob in a worker thread, or return None if missing"""
+        if not (stored := await self.locate(digest)):
+            return None
+        self.accessed.add(digest)
+        try:
+            if stored.pack is not None:
+                return await asyncio.to_thread(self._read_packed, stored.pack, digest)
+            return await asyncio.to_thread(stored.path.read_bytes)
+        except (FileNotFoundError, KeyError):
+            self.index.pop(digest, None)
+            return None
+
+    async def lookup(self, pre_key: str) -> str | None:
+        """Return the digest of the blob last saved for a protocol resource id"""
+        engine = await self.registry.create("main")
+        if row := await engine.scalar_eager(
+            AttachmentTable,
+            AttachmentTable.pre_key == pre_key,
+            order_by=AttachmentTable.id.desc(),
+        ):
+            return str(row.digest)
+        return None
+
+    async def acquire(
+        self,
+        digest: str,
+        path: Path,
+        *,
+        size: int | None = None,
+        mime: str | None = None,
+        pre_key: str | None = None,
+    ) -> bool:
+        """
+        Record a new reference to a stored blob at `path`.
+
+        The blob is checked for under the same transaction that `collect()`
+        removes blobs in, so a blob is either referenced or removed, never both.
+
+        Returns:
+            Whether the reference was recorded, False if the blob is missing
+        """
+        engine = await self.registry.create("main")
+        file_path = path.relative_to(self.root).as_posix()
+        async with engine.transaction() as tx:
+            row = await tx.scalar(AttachmentTable, AttachmentTable.digest == digest)
+            blob = self.root / str(row.pack) if row and row.pack else path
+            if not await asyncio.to_thread(blob.is_file):
+                return False
+            if row is None:
+                await tx.insert(
+                    AttachmentTable,
+                    pattern=self.selector(digest).display,
+                    file_path=file_path,
+                    digest=digest,
+                    pre_key=pre_key,
+                    size=size,
+                    mime=mime,
+                    refcount=1,
+                    create_time=datetime.now(),
+                    access_time=datetime.now(),
+                    deleted=False,
+                )
+            else:
+                await tx.execute(
+                    update(AttachmentTable)
+                    .where(AttachmentTable.digest == digest)
+                    .values(
+                        refcount=AttachmentTable.refcount + 1,
+                        access_time=datetime.now(),
+                        deleted=False,
+                        delete_time=None,
+                        **({"pre_key": pre_key} if pre_key else {}),
+                        # Rows backfilled for missing blobs point at a guessed path
+                        **({} if row.pack else {"file_path": file_path}),
+                    )
+                )
+        if digest not in self.index:
+            self.index[digest] = StoredAttachment(path, mime)
+        return True
+
+    async def release(self, *digests: str):
+        """Drop a reference to each blob, marking unreferenced blobs as deleted"""
+        if not digests:
+            return
+        engine = await self.registry.create("main")
+        async with engine.transaction() as tx:
+            for digest in digests:
+                await tx.execute(
+                    update(AttachmentTable)
+                    .where(
+                        AttachmentTable.digest == digest, AttachmentTable.refcount > 0
+                    )
+                    .values(refcount=AttachmentTable.refcount - 1)
+                )
+            await tx.execute(
+                update(AttachmentTable)
+                .where(
+                    AttachmentTable.digest.in_(digests),
+                    AttachmentTable.refcount <= 0,
+                    AttachmentTable.deleted.is_not(True),
+                )
+                .values(deleted=True, delete_time=datetime.now())
+            )
+
+    async def collect(self, grace: float) -> int:
+        """
+        Remove blobs unreferenced for longer than `grace` seconds.
+
+        Packs are removed once none of their blobs is left. Nothing is removed
+        until reference counts were backfilled.
+
+        Returns:
+            Number of removed blobs
+        """
+        if not self.counted:
+            logger.warning(
+                "[AttachmentStore] Reference counts are not backfilled, "
+                "skipping collection"
+            )
+            return 0
+        engine = await self.registry.create("main")
+        rows = await engine.all(
+            AttachmentTable,
+            AttachmentTable.deleted.is_(True),
+            AttachmentTable.delete_time < datetime.now() - timedelta(seconds=grace),
+        )
+        removed = 0
+        packs: set[str] = set()
+        for (row,) in rows:
+            async with engine.transaction() as tx:
+                result = await tx.execute(
+                    delete(AttachmentTable).where(
+                        AttachmentTable.id == row.id, AttachmentTable.refcount <= 0
+                    )
+                )
+                if not result.rowcount:
+                    continue
+                self.index.pop(str(row.digest), None)
+                if row.pack:
+                    packs.add(str(row.pack))
+                else:
+                    await asyncio.to_thread(
+                        (self.root / str(row.file_path)).unlink, missing_ok=True
+                    )
+                removed += 1
+        for pack in packs:
+            result = await engine.query(
+                select(func.count(AttachmentTable.id)).where(
+                    AttachmentTable.pack == pack
+                )
+            )
+            if not result.scalar():
+                if archive := self._packs.pop(self.root / pack, None):
+                    archive.close()
+                await asyncio.to_thread((self.root / pack).unlink, missing_ok=True)
+                logger.success(f"[AttachmentStore] Removed empty pack {pack}")
+        if removed:
+            logger.success(f"[AttachmentStore] Removed {removed} unreferenced blobs")
+        return removed
+
+    async def _flush_accessed(self):
+        if not self.accessed:
+            return
+        accessed, self.accessed = self.accessed, set()
+        engine = await self.registry.create("main")
+        now = datetime.now()
+        await engine.update_many(
+            AttachmentTable,
+            [{"digest": digest, "access_time": now} for digest in accessed],
+            ("digest",),
+        )
+
+    def _write_pack(self, rows: list) -> Path:
+        directory = self.root / PACK_DIRECTORY
+        directory.mkdir(parents=True, exist_ok=True)
+        temp = directory / f".{uuid4().hex}"
+        with ZipFile(temp, "w") as archive:
+            for row in rows:
+                archive.write(
+                    self.root / str(row.file_path),
+                    str(row.digest),
+                    (
+                        ZIP_STORED
+                        if str(row.mime or "").startswith(STORED_MIME_PREFIXES)
+                        else ZIP_DEFLATED
+                    ),
+                )
+        path = directory / f"{datetime.now():%Y%m%d%H%M%S}-{uuid4().hex[:8]}.zip"
+        os.replace(temp, path)
+        return path
+
+    async def _pack(self, rows: list) -> int:
+        engine = await self.registry.create("main")
+        pack = await asyncio.to_thread(self._write_pack, rows)
+        name = pack.relative_to(self.root).as_posix()
+        await engine.update_many(
+            AttachmentTable,
+            [{"digest": row.digest, "pack": name} for row in rows],
+            ("digest",),
+        )
+        for row in rows:
+            stored = self._stored(row)
+            stored.pack = pack
+            self.index[str(row.digest)] = stored
+            await asyncio.to_thread(stored.path.unlink, missing_ok=True)
+        logger.success(f"[AttachmentStore] Packed {len(rows)} blobs into {name}")
+        return len(rows)
+
+    async def tier(self, cold_after: float, pack_size: int) -> int:
+        """
+        Move blobs not accessed for `cold_after` seconds into zip packs.
+
+        Each pack holds about `pack_size` bytes. Media blobs are stored as-is
+        since they are already compressed, others are deflated.
+
+        Returns:
+            Number of packed blobs
+        """
+        await self._flush_accessed()
+        engine = await self.registry.create("main")
+        deadline = datetime.now() - timedelta(seconds=cold_after)
+        packed = 0
+        batch, total = [], 0
+        async for rows in engine.paginate(
+            AttachmentTable,
+            AttachmentTable.digest.is_not(None),
+            AttachmentTable.pack.is_(None),
+            AttachmentTable.deleted.is_not(True),
+            or_(
+                AttachmentTable.access_time < deadline,
+                and_(
+                    AttachmentTable.access_time.is_(None),
+                    AttachmentTable.create_time < deadline,
+                ),
+            ),
+        ):
+            sizes = []
+            for row in rows:
+                size = await asyncio.to_thread(
+                    self._size, self.root / str(row.file_path)
+                )
+                if size is None:
+                    continue
+                if row.size is None:
+                    # Backfilled rows never recorded the size of their blob
+                    sizes.append({"digest": row.digest, "size": size})
+                batch.append(row)
+                total += size
+                if total >= pack_size:
+                    packed += await self._pack(batch)
+                    batch, total = [], 0
+            if sizes:
+                await engine.update_many(AttachmentTable, sizes, ("digest",))
+        if batch:
+            packed += await self._pack(batch)
+        return packed
+
+    def close(self):
+        for archive in self._packs.values():
+            archive.close()
+        self._packs.clear()
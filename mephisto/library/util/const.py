@@ -5,6 +5,7 @@ from mephisto.shared import DATA_ROOT
 
 TEMPORARY_FILES_ROOT: Final[Path] = DATA_ROOT / "temp"
 FILES_STORAGE_ROOT: Final[Path] = DATA_ROOT / "files"
+ATTACHMENT_ROOT: Final[Path] = DATA_ROOT / "attachment"
 
 TEMPORARY_FILE_ENDPOINT: Final[str] = "/core/service/temp"
 MODULE_ASSET_ENDPOINT: Final[str] = "/core/service/module/asset"
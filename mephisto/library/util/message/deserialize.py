@@ -1,6 +1,8 @@
-import json
+import ast
 import re
-from typing import Any
+from contextlib import suppress
+from itertools import zip_longest
+from typing import Any, Callable, Iterable
 
 from avilla.core.elements import Audio as CoreAudio
 from avilla.core.elements import Face as CoreFace
@@ -42,7 +44,14 @@ from graia.amnesia.message.chain import MessageChain
 from graia.amnesia.message.element import Element
 
 from mephisto.library.model.exception import MessageDeserializationFailed
+from mephisto.library.util.message.dispatch import DispatchTable, loads
 from mephisto.library.util.message.resource import RecordAttachmentResource
+from mephisto.library.util.message.serialize import (
+    COMPACT_PREFIX,
+    SELECTOR_FIELDS,
+    encode_compact,
+    serialize,
+)
 
 _ELEMENT_OVERLOAD = SimpleOverload("element")
 _RAW_TYPE_OVERLOAD = SimpleOverload("raw_type")
@@ -58,7 +67,13 @@ def impl_deserialize(raw_type: str, element: str):
     return shape
 
 
-def deserialize_element(raw_type: str, element: str, raw: Any) -> Element:
+_Deserializer = Callable[[str, str, Any], Element]
+_dispatch_table: DispatchTable[str, _Deserializer] = DispatchTable(
+    impl_deserialize, _RAW_TYPE_OVERLOAD, _ELEMENT_OVERLOAD
+)
+
+
+def _select_element(raw_type: str, element: str, raw: Any) -> Element:
     for selection in impl_deserialize.select():
         if not selection.harvest(_ELEMENT_OVERLOAD, element) or not selection.harvest(
             _RAW_TYPE_OVERLOAD, raw_type
@@ -70,23 +85,77 @@ def deserialize_element(raw_type: str, element: str, raw: Any) -> Element:
     return selection(raw_type, element, raw)  # type: ignore  # noqa
 
 
+def deserialize_element(
+    raw_type: str,
+    element: str,
+    raw: Any,
+    table: dict[tuple[str, str], _Deserializer] | None = None,
+) -> Element:
+    if table is None:
+        table = _dispatch_table()
+    if (impl := table.get((raw_type, element))) is not None:
+        return impl(raw_type, element, raw)
+    return _select_element(raw_type, element, raw)
+
+
 # <editor-fold desc="Deserialize">
 # <editor-fold desc="Deserialize (repr)">
 # Reserved for backward compatibility
+_REPR_TOKEN_PATTERN = re.compile(r"(?:\[\$?)?(?P<element>[a-zA-Z]+)(?:[:(].+?[)\]])?, ")
+# Anchored to the end of the token, so that text containing ")" keeps parsing
+_REPR_TEXT_PATTERN = re.compile(
+    r"(?P<element>Text)\(text=(?P<text>.+?)(?:, style=(?P<style>.+?))?\)(?:, )?$"
+)
+_REPR_NOTICE_PATTERN = re.compile(r"\[\$?(?P<element>Notice):target=(?P<target>.+?)]")
+_REPR_RESOURCE_PATTERNS = {
+    element: re.compile(rf"\[\$?(?P<element>{element}):resource=(?P<resource>.+)]")
+    for element in ("Picture", "Audio", "Video", "File")
+}
+_REPR_REFERENCE_PATTERN = re.compile(r"\[\$?(?P<element>Reference):id=(?P<message>.+)]")
+_REPR_FACE_PATTERN = re.compile(
+    r"\[\$?(?P<element>Face):id=(?P<id>.+);name=(?P<name>.+)]"
+)
+
+
+def _repr_resource(raw_type: str, element: str, raw: str) -> RecordAttachmentResource:
+    if not (match := _REPR_RESOURCE_PATTERNS[element].match(raw)):
+        raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
+    return RecordAttachmentResource(
+        Selector.from_follows(match["resource"].split("Selector().")[-1])
+    )
+
+
+def _repr_string(raw_type: str, element: str, raw: str, value: str) -> str:
+    """Undo the quoting of a string field, if the repr quoted it"""
+    if not value.startswith(("'", '"')):
+        return value
+    with suppress(ValueError, SyntaxError):
+        if isinstance(literal := ast.literal_eval(value), str):
+            return literal
+    # A quoted value that is not a literal was cut short by the tokenizer
+    raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
+
+
 @global_collect
 @impl_deserialize(raw_type="repr", element="Text")
 def deserialize_repr_text(raw_type: str, element: str, raw: str) -> CoreText:
-    pattern = r"(?P<element>Text)\(text=(?P<text>.+?)(?:, style=(?P<style>.+?))?\)"
-    if not (match := re.match(pattern, raw)):
+    if not (match := _REPR_TEXT_PATTERN.match(raw)):
         raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
-    return CoreText(match["text"], match["style"])
+    style = match["style"]
+    return CoreText(
+        _repr_string(raw_type, element, raw, match["text"]),
+        (
+            _repr_string(raw_type, element, raw, style)
+            if style is not None and style != "None"
+            else None
+        ),
+    )
 
 
 @global_collect
 @impl_deserialize(raw_type="repr", element="Notice")
 def deserialize_repr_notice(raw_type: str, element: str, raw: str) -> CoreNotice:
-    pattern = r"\[\$?(?P<element>Notice):target=(?P<target>.+?)]"
-    if not (match := re.match(pattern, raw)):
+    if not (match := _REPR_NOTICE_PATTERN.match(raw)):
         raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
     return CoreNotice(
         Selector.from_follows(match["target"].split("Selector().")[-1]),
@@ -102,60 +171,31 @@ def deserialize_repr_notice_all(raw_type: str, element: str, raw: str) -> CoreNo
 @global_collect
 @impl_deserialize(raw_type="repr", element="Picture")
 def deserialize_repr_picture(raw_type: str, element: str, raw: str) -> CorePicture:
-    pattern = r"\[\$?(?P<element>Picture):resource=(?P<resource>.+)]"
-    if not (match := re.match(pattern, raw)):
-        raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
-    return CorePicture(
-        RecordAttachmentResource(
-            Selector.from_follows(match["resource"].split("Selector().")[-1])
-        )
-    )
+    return CorePicture(_repr_resource(raw_type, element, raw))
 
 
 @global_collect
 @impl_deserialize(raw_type="repr", element="Audio")
 def deserialize_repr_audio(raw_type: str, element: str, raw: str) -> CoreAudio:
-    pattern = r"\[\$?(?P<element>Audio):resource=(?P<resource>.+)]"
-    if not (match := re.match(pattern, raw)):
-        raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
-    return CoreAudio(
-        RecordAttachmentResource(
-            Selector.from_follows(match["resource"].split("Selector().")[-1])
-        )
-    )
+    return CoreAudio(_repr_resource(raw_type, element, raw))
 
 
 @global_collect
 @impl_deserialize(raw_type="repr", element="Video")
 def deserialize_repr_video(raw_type: str, element: str, raw: str) -> CoreVideo:
-    pattern = r"\[\$?(?P<element>Video):resource=(?P<resource>.+)]"
-    if not (match := re.match(pattern, raw)):
-        raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
-    return CoreVideo(
-        RecordAttachmentResource(
-            Selector.from_follows(match["resource"].split("Selector().")[-1])
-        )
-    )
+    return CoreVideo(_repr_resource(raw_type, element, raw))
 
 
 @global_collect
 @impl_deserialize(raw_type="repr", element="File")
 def deserialize_repr_file(raw_type: str, element: str, raw: str) -> CoreFile:
-    pattern = r"\[\$?(?P<element>File):resource=(?P<resource>.+)]"
-    if not (match := re.match(pattern, raw)):
-        raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
-    return CoreFile(
-        RecordAttachmentResource(
-            Selector.from_follows(match["resource"].split("Selector().")[-1])
-        )
-    )
+    return CoreFile(_repr_resource(raw_type, element, raw))
 
 
 @global_collect
 @impl_deserialize(raw_type="repr", element="Reference")
 def deserialize_repr_reference(raw_type: str, element: str, raw: str) -> CoreReference:
-    pattern = r"\[\$?(?P<element>Reference):id=(?P<message>.+)]"
-    if not (match := re.match(pattern, raw)):
+    if not (match := _REPR_REFERENCE_PATTERN.match(raw)):
         raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
     return CoreReference(
         Selector.from_follows(match["message"]),
@@ -165,8 +205,7 @@ def deserialize_repr_reference(raw_type: str, element: str, raw: str) -> CoreRef
 @global_collect
 @impl_deserialize(raw_type="repr", element="Face")
 def deserialize_repr_face(raw_type: str, element: str, raw: str) -> CoreFace:
-    pattern = r"\[\$?(?P<element>Face):id=(?P<id>.+);name=(?P<name>.+)]"
-    if not (match := re.match(pattern, raw)):
+    if not (match := _REPR_FACE_PATTERN.match(raw)):
         raise MessageDeserializationFailed(element=element, raw_type=raw_type, raw=raw)
     return CoreFace(
         match["id"],
@@ -174,19 +213,18 @@ def deserialize_repr_face(raw_type: str, element: str, raw: str) -> CoreFace:
     )
 
 
-def deserialize_repr(raw: str) -> MessageChain:
+def deserialize_repr(
+    raw: str, table: dict[tuple[str, str], _Deserializer] | None = None
+) -> MessageChain:
     raw = raw[14:-2] + ", "  # MessageChain([...])
-    combined_pattern = re.compile(
-        r"(?:\[\$?)?(?P<element>[a-zA-Z]+)(?:[:(].+?[)\]])?, "
-    )
+    table = table if table is not None else _dispatch_table()
     chain = []
-    while raw:
-        match = combined_pattern.match(raw)
-        if not match:
-            raise MessageDeserializationFailed(raw=raw)
-        element = match["element"]
-        raw = raw[match.end() :]
-        chain.append(deserialize_element("repr", element, match.group(0)))
+    position = 0
+    while position < len(raw):
+        if not (match := _REPR_TOKEN_PATTERN.match(raw, position)):
+            raise MessageDeserializationFailed(raw=raw[position:])
+        position = match.end()
+        chain.append(deserialize_element("repr", match["element"], match[0], table))
     return MessageChain(chain)
 
 
@@ -511,20 +549,74 @@ def deserialize_json_tg_story(
 # </editor-fold>
 
 
-def deserialize_json(raw: str) -> MessageChain:
+def deserialize_json(
+    raw: str, table: dict[tuple[str, str], _Deserializer] | None = None
+) -> MessageChain:
     raw = raw[5:]  # json:[{...}]
-    data: list[dict[str, Any]] = json.loads(raw)
-    chain = [deserialize_element("json", element["_type"], element) for element in data]
+    data: list[dict[str, Any]] = loads(raw)
+    table = table if table is not None else _dispatch_table()
+    chain = [
+        deserialize_element("json", element["_type"], element, table)
+        for element in data
+    ]
     return MessageChain(chain)
 
 
 # </editor-fold>
 
 
-def deserialize(raw: str) -> MessageChain:
-    if raw.startswith("json:"):
-        return deserialize_json(raw)
+def decode_compact(raw: str) -> list[dict[str, Any]]:
+    """Decode the compact format back into serialized elements"""
+    types, selectors, elements = loads(raw[len(COMPACT_PREFIX) :])
+    decoded = []
+    for code, *values in elements:
+        element, *keys = types[code]
+        data = {"_type": element}
+        for key, value in zip_longest(keys, values):
+            data[key] = (
+                selectors[value]
+                if key in SELECTOR_FIELDS and isinstance(value, int)
+                else value
+            )
+        decoded.append(data)
+    return decoded
+
+
+def deserialize_compact(
+    raw: str, table: dict[tuple[str, str], _Deserializer] | None = None
+) -> MessageChain:
+    table = table if table is not None else _dispatch_table()
+    return MessageChain(
+        [
+            deserialize_element("json", data["_type"], data, table)
+            for data in decode_compact(raw)
+        ]
+    )
+
+
+def deserialize(
+    raw: str, table: dict[tuple[str, str], _Deserializer] | None = None
+) -> MessageChain:
+    if raw.startswith(COMPACT_PREFIX):
+        return deserialize_compact(raw, table)
+    elif raw.startswith("json:"):
+        return deserialize_json(raw, table)
     elif raw.startswith("MessageChain"):
-        return deserialize_repr(raw)
+        return deserialize_repr(raw, table)
     else:
         raise MessageDeserializationFailed(raw=raw)
+
+
+def deserialize_many(rows: Iterable[str]) -> list[MessageChain]:
+    """Deserialize the content of many records, resolving dispatch only once"""
+    table = _dispatch_table()
+    return [deserialize(raw, table) for raw in rows]
+
+
+def reencode(raw: str) -> str:
+    """Convert stored record content to the current encoding"""
+    if raw.startswith(COMPACT_PREFIX):
+        return raw
+    elif raw.startswith("json:"):
+        return encode_compact(loads(raw[5:]))
+    return serialize(deserialize(raw))
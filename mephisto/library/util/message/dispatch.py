@@ -0,0 +1,81 @@
+import json
+from contextlib import suppress
+from typing import Any, Callable, Generic, TypeVar
+
+from flywheel import FnCollectEndpoint, FnOverload
+from flywheel.globals import iter_layout
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_K = TypeVar("_K")
+_F = TypeVar("_F", bound=Callable)
+
+
+def dumps(data: Any) -> str:
+    if orjson is not None:
+        with suppress(TypeError):
+            return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(raw: str) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+class DispatchTable(Generic[_K, _F]):
+    """
+    Map `(raw_type, element)` to the implementation collected for an endpoint.
+
+    The table mirrors what flywheel would select in the current lookup layout,
+    and is rebuilt only when the layout or the collected implementations change.
+    """
+
+    endpoint: FnCollectEndpoint
+    raw_type: FnOverload
+    element: FnOverload
+
+    def __init__(
+        self, endpoint: FnCollectEndpoint, raw_type: FnOverload, element: FnOverload
+    ):
+        self.endpoint = endpoint
+        self.raw_type = raw_type
+        self.element = element
+        self._table: dict[tuple[str, _K], _F] = {}
+        self._version: tuple = ()
+
+    def __call__(self) -> dict[tuple[str, _K], _F]:
+        signature = self.endpoint.signature
+        records = [
+            layer.fn_implements[signature]
+            for layer in iter_layout(self.endpoint)
+            if signature in layer.fn_implements
+        ]
+        # Collecting an implementation only adds it to the scopes of a record
+        version = tuple(
+            (
+                id(record),
+                tuple(
+                    sum(map(len, scope.values())) for scope in record.scopes.values()
+                ),
+            )
+            for record in records
+        )
+        if version == self._version:
+            return self._table
+        table: dict[tuple[str, _K], _F] = {}
+        # Flywheel picks the first layer with a match, so earlier layers win
+        for record in reversed(records):
+            elements = record.scopes.get(self.element.name, {})
+            for raw_type, raw_impls in record.scopes.get(
+                self.raw_type.name, {}
+            ).items():
+                for element, element_impls in elements.items():
+                    for impl in element_impls:
+                        if impl in raw_impls:
+                            table[(raw_type, element)] = impl
+                            break
+        self._table, self._version = table, version
+        return table
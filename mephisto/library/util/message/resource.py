@@ -1,6 +1,12 @@
+import asyncio
 import hashlib
+import os
+from asyncio import Semaphore
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import TypeVar
+from typing import AsyncGenerator, BinaryIO, Final, TypeVar
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
 import filetype
 from avilla.core import Context, Resource
@@ -10,11 +16,23 @@ from avilla.core.resource import LocalFileResource, RawResource, UrlResource
 from avilla.core.ryanvk.collector.application import ApplicationCollector
 from avilla.core.selector import Selector
 from avilla.standard.qq.elements import MarketFace
+from creart import it
 from graia.amnesia.message import Element, MessageChain
+from kayaku import create
+from launart import Launart
 from loguru import logger
+from yarl import URL
 
+from mephisto.library.model.config import MephistoConfig
 from mephisto.library.model.exception import AttachmentRecordNotFound
-from mephisto.shared import DATA_ROOT
+from mephisto.library.service import DataService
+from mephisto.library.util.attachment import AttachmentStore
+from mephisto.library.util.storage import stream_file
+
+CHUNK_SIZE: Final[int] = 262144
+SNIFF_SIZE: Final[int] = 8192
+SPILL_SIZE: Final[int] = 1048576
+INCOMING_DIRECTORY: Final[str] = ".incoming"
 
 
 class RecordAttachmentResource(Resource[bytes]):
@@ -29,13 +47,9 @@ class RecordResourceFetchPerform((m := ApplicationCollector())._):
 
     @m.entity(CoreCapability.fetch, resource=RecordAttachmentResource)
     async def fetch_attachment(self, resource: RecordAttachmentResource):
-        if file := next(
-            (
-                DATA_ROOT / "attachment" / resource.digest[:2] / resource.digest[2:4]
-            ).rglob(f"{resource.digest}*"),
-            None,
-        ):
-            return file.read_bytes()
+        store = it(Launart).get_component(DataService).attachments
+        if (raw := await store.read(resource.digest)) is not None:
+            return raw
         raise AttachmentRecordNotFound(resource)
 
 
@@ -53,12 +67,199 @@ def extract_resources(message: MessageChain) -> list[tuple[int, Element, Resourc
 _translation: dict = {MarketFace: lambda _: UrlResource(_.url)}
 
 
+class _FetchLimiter:
+    """Bound concurrent resource fetches globally and per host"""
+
+    def __init__(self):
+        self._global: Semaphore | None = None
+        self._hosts: WeakValueDictionary[str, Semaphore] = WeakValueDictionary()
+
+    @staticmethod
+    def host(resource: Resource) -> str | None:
+        if isinstance(resource, UrlResource):
+            return URL(resource.url).host
+        if isinstance(resource, (LocalFileResource, RawResource)):
+            return None
+        return resource.to_selector().pattern.get("land")
+
+    @asynccontextmanager
+    async def limit(self, resource: Resource):
+        cfg = create(MephistoConfig).network
+        if self._global is None:
+            self._global = Semaphore(cfg.download_concurrency)
+        if (host := self.host(resource)) is None:
+            async with self._global:
+                yield
+            return
+        if (semaphore := self._hosts.get(host)) is None:
+            semaphore = self._hosts[host] = Semaphore(cfg.download_host_concurrency)
+        async with semaphore, self._global:
+            yield
+
+
+_limiter = _FetchLimiter()
+
+
+class _IncomingAttachment:
+    """
+    An attachment being received, hashed while being written.
+
+    Data is kept in memory up to `SPILL_SIZE` bytes, so that duplicates of small
+    blobs never touch the disk, and spilled to a temporary file in `incoming`
+    beyond that. Blocking; every method is meant to be run in a worker thread.
+    """
+
+    def __init__(self, incoming: Path):
+        self.incoming = incoming
+        self.head = b""
+        self.size = 0
+        self.md5 = hashlib.md5()
+        self.buffer = bytearray()
+        self.temp: Path | None = None
+        self.file: BinaryIO | None = None
+
+    def write(self, chunk: bytes | memoryview):
+        if len(self.head) < SNIFF_SIZE:
+            self.head += bytes(chunk[: SNIFF_SIZE - len(self.head)])
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        if self.file is None and self.size <= SPILL_SIZE:
+            self.buffer += chunk
+            return
+        if self.file is None:
+            self.incoming.mkdir(parents=True, exist_ok=True)
+            self.temp = self.incoming / uuid4().hex
+            self.file = self.temp.open("wb")
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        self.file.write(chunk)
+
+    def commit(self, path: Path):
+        """Move the received data to `path`"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.file is None:
+            self.temp = self.incoming / uuid4().hex
+            self.incoming.mkdir(parents=True, exist_ok=True)
+            self.temp.write_bytes(self.buffer)
+        else:
+            self.file.close()
+        os.replace(self.temp, path)  # type: ignore
+        self.temp = None
+
+    def discard(self):
+        self.buffer = bytearray()
+        if self.file is not None:
+            self.file.close()
+        if self.temp is not None:
+            self.temp.unlink(missing_ok=True)
+
+
+def _pre_key(resource: Resource) -> str | None:
+    if isinstance(resource, (UrlResource, LocalFileResource, RawResource)):
+        return None
+    return resource.to_selector().display
+
+
+async def _iter_resource(
+    ctx: Context, resource: Resource, chunk_size: int = CHUNK_SIZE
+) -> AsyncGenerator[bytes | memoryview, None]:
+    if isinstance(resource, UrlResource):
+        async for chunk in stream_file(resource.url, chunk_size=chunk_size):
+            yield chunk
+        return
+    if isinstance(resource, LocalFileResource):
+        with await asyncio.to_thread(Path(resource.file).open, "rb") as file:
+            while chunk := await asyncio.to_thread(file.read, chunk_size):
+                yield chunk
+        return
+    # Avilla's fetch returns the whole payload, so raw and platform resources
+    # (the usual QQ and Telegram attachments) are held in memory at once
+    if isinstance(resource, RawResource):
+        raw = await CoreResourceFetchPerform(ctx.staff).fetch_raw(resource)
+    else:
+        raw = await ctx.fetch(resource)
+    view = memoryview(raw)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]
+
+
+async def _ingest(
+    ctx: Context, store: AttachmentStore, resource: Resource, pre_key: str | None
+) -> tuple[Path, str]:
+    incoming = _IncomingAttachment(store.root / INCOMING_DIRECTORY)
+    try:
+        async for chunk in _iter_resource(ctx, resource):
+            await asyncio.to_thread(incoming.write, chunk)
+        digest = incoming.md5.hexdigest()
+        mime = filetype.guess_mime(incoming.head)
+        # The stored blob may be collected until it is acquired, keep the
+        # incoming data until then
+        if (path := await store.find(digest)) is not None and await store.acquire(
+            digest, path, size=incoming.size, mime=mime, pre_key=pre_key
+        ):
+            logger.debug(f"Resource already stored at {path}")
+            return path, digest
+        if not (ext := filetype.guess_extension(incoming.head)):
+            logger.warning("Cannot guess file type of resource")
+        path = store.path(digest, ext)
+        await asyncio.to_thread(incoming.commit, path)
+        logger.debug(f"Saved resource to {path}")
+        await store.acquire(
+            digest, path, size=incoming.size, mime=mime, pre_key=pre_key
+        )
+        return path, digest
+    finally:
+        await asyncio.to_thread(incoming.discard)
+
+
+async def _save_resource(
+    ctx: Context, store: AttachmentStore, element: Element, resource: Resource
+) -> Path | Exception:
+    try:
+        logger.debug(
+            f"Fetching resource {type(resource)}({resource.to_selector().display})"
+        )
+        pre_key = _pre_key(resource)
+        async with _limiter.limit(resource):
+            if (
+                pre_key
+                and (digest := await store.lookup(pre_key))
+                and (path := await store.find(digest))
+                and await store.acquire(digest, path)
+            ):
+                logger.debug(f"Resource already stored at {path}")
+            else:
+                path, digest = await _ingest(ctx, store, resource, pre_key)
+        setattr(element, "resource", RecordAttachmentResource(store.selector(digest)))
+        return path
+    except NotImplementedError as e:
+        logger.error(
+            f"Fetching resource {type(resource)}"
+            f"({resource.to_selector().display}) is not supported"
+        )
+        return e
+    except Exception as e:
+        logger.error(f"Error fetching resource: {e}")
+        return e
+
+
 async def save_resources(
     ctx: Context,
     message_chain: MessageChain,
-    base_path: Path = DATA_ROOT / "attachment",
+    store: AttachmentStore | None = None,
 ) -> list[Path | Exception]:
-    results: list[Path | Exception] = []
+    """
+    Fetch and save the resources of a message chain concurrently.
+
+    Resources are streamed in chunks and hashed on the way; blobs already in the
+    store, looked up by protocol resource id before fetching or by digest after,
+    are only referenced again. Fetches are bounded by
+    `network.download_concurrency` across all chains and by
+    `network.download_host_concurrency` per host; results follow the order of
+    the elements.
+    """
+    store = store or it(Launart).get_component(DataService).attachments
+    tasks = []
     for element in message_chain:
         if type(element) in _translation:
             resource = _translation[type(element)](element)
@@ -69,44 +270,5 @@ async def save_resources(
             continue
         else:
             resource: Resource = element.resource  # type: ignore
-        try:
-            logger.debug(
-                f"Fetching resource {type(resource)}({resource.to_selector().display})"
-            )
-            if isinstance(resource, LocalFileResource):
-                raw = await CoreResourceFetchPerform(ctx.staff).fetch_localfile(
-                    resource
-                )
-            elif isinstance(resource, RawResource):
-                raw = await CoreResourceFetchPerform(ctx.staff).fetch_raw(resource)
-            elif isinstance(resource, UrlResource):
-                raw = await CoreResourceFetchPerform(ctx.staff).fetch_url(resource)
-            else:
-                raw = await ctx.fetch(resource)
-            digest = hashlib.md5(raw).hexdigest()
-            path = base_path / digest[:2] / digest[2:4] / digest
-            path.parent.mkdir(parents=True, exist_ok=True)
-            if ext := filetype.guess_extension(raw):
-                path = path.with_suffix(f".{ext}")
-            else:
-                logger.warning("Cannot guess file type of resource")
-            path.write_bytes(raw)
-            logger.debug(f"Saved resource to {path}")
-            results.append(path)
-            setattr(
-                element,
-                "resource",
-                RecordAttachmentResource(
-                    Selector().land("mephisto-attachment").digest(digest)
-                ),
-            )
-        except NotImplementedError as e:
-            logger.error(
-                f"Fetching resource {type(resource)}"
-                f"({resource.to_selector().display}) is not supported"
-            )
-            results.append(e)
-        except Exception as e:
-            logger.error(f"Error fetching resource: {e}")
-            results.append(e)
-    return results
+        tasks.append(_save_resource(ctx, store, element, resource))
+    return list(await asyncio.gather(*tasks))
@@ -1,5 +1,5 @@
 import json
-from typing import Any
+from typing import Any, Callable, Final, Iterable
 
 from avilla.core.elements import Audio as CoreAudio
 from avilla.core.elements import Face as CoreFace
@@ -35,6 +35,11 @@ from flywheel import FnCollectEndpoint, SimpleOverload, TypeOverload, global_col
 from graia.amnesia.message.chain import MessageChain
 from graia.amnesia.message.element import Element
 
+from mephisto.library.util.message.dispatch import DispatchTable, dumps
+
+COMPACT_PREFIX: Final[str] = "c1:"
+SELECTOR_FIELDS: Final[frozenset[str]] = frozenset({"target", "resource"})
+
 _RAW_TYPE_OVERLOAD = SimpleOverload("raw_type")
 _ELEMENT_OVERLOAD = TypeOverload("element")
 
@@ -49,7 +54,13 @@ def impl_serialize(raw_type: str, element: type[Element]):
     return shape
 
 
-def serialize_element(raw_type: str, element: Element) -> dict[str, Any]:
+_Serializer = Callable[[str, Element], dict[str, Any]]
+_dispatch_table: DispatchTable[type[Element], _Serializer] = DispatchTable(
+    impl_serialize, _RAW_TYPE_OVERLOAD, _ELEMENT_OVERLOAD
+)
+
+
+def _select_element(raw_type: str, element: Element) -> dict[str, Any]:
     for selection in impl_serialize.select():
         if not selection.harvest(_RAW_TYPE_OVERLOAD, raw_type) or not selection.harvest(
             _ELEMENT_OVERLOAD, element
@@ -61,6 +72,18 @@ def serialize_element(raw_type: str, element: Element) -> dict[str, Any]:
     return selection(raw_type, element)  # type: ignore  # noqa
 
 
+def serialize_element(
+    raw_type: str,
+    element: Element,
+    table: dict[tuple[str, type[Element]], _Serializer] | None = None,
+) -> dict[str, Any]:
+    if table is None:
+        table = _dispatch_table()
+    if (impl := table.get((raw_type, type(element)))) is not None:
+        return impl(raw_type, element)
+    return _select_element(raw_type, element)
+
+
 # <editor-fold desc="Serialize (json)">
 # <editor-fold desc="Standard Core Elements">
 @global_collect
@@ -340,7 +363,50 @@ def serialize_json_tg_story(raw_type: str, element: TgStory) -> dict:
 # </editor-fold>
 
 
-def serialize(chain: MessageChain) -> str:
+def serialize_json(chain: MessageChain) -> str:
+    table = _dispatch_table()
     return "json:" + json.dumps(
-        [serialize_element("json", element) for element in chain], ensure_ascii=False
+        [serialize_element("json", element, table) for element in chain],
+        ensure_ascii=False,
     )
+
+
+def encode_compact(elements: Iterable[dict[str, Any]]) -> str:
+    """
+    Encode serialized elements in the compact format.
+
+    The payload is `[types, selectors, elements]`: every distinct element type
+    and key order is listed once in `types` as `[_type, *keys]`, selector
+    displays are listed once in `selectors`, and each element is stored as
+    `[type_index, *values]` with selector fields replaced by their index and
+    trailing nulls omitted.
+    """
+    types: dict[tuple[str, ...], int] = {}
+    selectors: dict[str, int] = {}
+    encoded = []
+    for data in elements:
+        fields = [(key, value) for key, value in data.items() if key != "_type"]
+        schema = (data["_type"], *(key for key, _ in fields))
+        values = [
+            (
+                selectors.setdefault(value, len(selectors))
+                if key in SELECTOR_FIELDS and isinstance(value, str)
+                else value
+            )
+            for key, value in fields
+        ]
+        while values and values[-1] is None:
+            values.pop()
+        encoded.append([types.setdefault(schema, len(types)), *values])
+    return COMPACT_PREFIX + dumps([list(types), list(selectors), encoded])
+
+
+def serialize_compact(chain: MessageChain) -> str:
+    table = _dispatch_table()
+    return encode_compact(
+        serialize_element("json", element, table) for element in chain
+    )
+
+
+def serialize(chain: MessageChain) -> str:
+    return serialize_compact(chain)
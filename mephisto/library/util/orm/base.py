@@ -1,40 +1,295 @@
 from asyncio import Semaphore
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator, TypeVar
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Final, Iterable, Iterator, Sequence, TypeVar
 
 from loguru import logger
-from sqlalchemy import Executable, Result, delete, insert, inspect, select, update
-from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy import (
+    BinaryExpression,
+    BindParameter,
+    ClauseElement,
+    Column,
+    ColumnClause,
+    Executable,
+    Result,
+    bindparam,
+    delete,
+    event,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql import operators
 
 Base = declarative_base()
 _T = TypeVar("_T")
+CACHEABLE_OPERATORS: Final[frozenset] = frozenset(
+    {
+        operators.eq,
+        operators.ne,
+        operators.lt,
+        operators.le,
+        operators.gt,
+        operators.ge,
+        operators.in_op,
+        operators.not_in_op,
+    }
+)
 
 
 class DatabaseEngine:
     engine: AsyncEngine
     mutex: Semaphore | None
+    readers: Semaphore | None
+    pragmas: dict[str, Any]
+    unique_keys: dict[str, set[frozenset[str]]]
+    statements: OrderedDict[tuple, Executable]
+    statement_cache_size: int
+    cache_hits: int
+    cache_misses: int
+    users: int
 
-    def __init__(self, link: str, mutex: Semaphore | None = None, **adapter):
+    def __init__(
+        self,
+        link: str,
+        mutex: Semaphore | None = None,
+        readers: Semaphore | None = None,
+        pragmas: dict[str, Any] | None = None,
+        statement_cache_size: int = 256,
+        **adapter,
+    ):
+        """
+        Args:
+            link: Database URL
+            mutex: Lock serializing writes, no limit if None
+            readers: Lock bounding concurrent reads, reads share `mutex` if None
+            pragmas: PRAGMAs executed on every new SQLite connection
+            statement_cache_size: Number of statement shapes kept by `prepare()`
+            **adapter: Arguments passed to create_async_engine
+        """
         self.engine = create_async_engine(link, **adapter, echo=False)
         self.mutex = mutex
+        self.readers = readers
+        self.pragmas = pragmas or {}
+        self.unique_keys = {}
+        self.statements = OrderedDict()
+        self.statement_cache_size = statement_cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.users = 0
+        self._bound: ContextVar[AsyncConnection | None] = ContextVar(
+            f"DatabaseEngine@{id(self)}", default=None
+        )
+        if self.pragmas and self.engine.dialect.name == "sqlite":
+            event.listen(self.engine.sync_engine, "connect", self._apply_pragmas)
+
+    def _apply_pragmas(self, dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for key, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {key}={value}")
+        cursor.close()
+
+    @property
+    def in_use(self) -> bool:
+        """Whether an operation is running or waiting on this engine"""
+        return self.users > 0
 
     @asynccontextmanager
     async def lock(self):
+        self.users += 1
+        acquired = False
         try:
             if self.mutex:
                 await self.mutex.acquire()
+                acquired = True
             yield
         finally:
-            if self.mutex:
-                self.mutex.release()
+            if acquired:
+                self.mutex.release()  # type: ignore
+            self.users -= 1
+
+    @asynccontextmanager
+    async def read_lock(self):
+        if self.readers is None:
+            async with self.lock():
+                yield
+            return
+        self.users += 1
+        try:
+            async with self.readers:
+                yield
+        finally:
+            self.users -= 1
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncGenerator[AsyncConnection, None]:
+        """Yield the connection bound by `begin()`, or a new transactional one"""
+        if (conn := self._bound.get()) is not None:
+            yield conn
+            return
+        async with self.lock():
+            async with self.engine.begin() as conn:
+                if self.engine.dialect.name == "sqlite":
+                    # pysqlite only opens transactions before DML, begin
+                    # explicitly so that DDL is covered as well
+                    await conn.exec_driver_sql("BEGIN")
+                yield conn
+
+    @asynccontextmanager
+    async def begin(self) -> AsyncGenerator[AsyncConnection, None]:
+        """Run every helper awaited inside the block in one transaction"""
+        if (conn := self._bound.get()) is not None:
+            yield conn
+            return
+        async with self.connection() as conn:
+            token = self._bound.set(conn)
+            try:
+                yield conn
+            finally:
+                self._bound.reset(token)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncGenerator["Transaction", None]:
+        """
+        Open a unit of work whose helpers share one connection and one commit.
+
+        Changes are committed when the block exits and rolled back if it raises;
+        engine helpers awaited inside the block join the same transaction.
+        """
+        async with self.begin() as conn:
+            async with AsyncSession(bind=conn) as session:
+                yield Transaction(self, session)
 
     @asynccontextmanager
     async def session(self):
+        if (conn := self._bound.get()) is not None:
+            async with AsyncSession(bind=conn) as session:
+                yield session
+            return
         async with self.lock():
             async with AsyncSession(self.engine) as session:
                 yield session
 
+    @asynccontextmanager
+    async def read_session(self):
+        if (conn := self._bound.get()) is not None:
+            async with AsyncSession(bind=conn) as session:
+                yield session
+            return
+        async with self.read_lock():
+            async with AsyncSession(self.engine) as session:
+                yield session
+
+    def prepare(
+        self,
+        kind: str,
+        table,
+        *where,
+        values: dict[str, Any] | None = None,
+        order_by=None,
+        limit: int | None = None,
+    ) -> tuple[Executable, dict[str, Any]]:
+        """
+        Build a `select`, `insert`, `update` or `delete` statement of `table`.
+
+        Where clauses comparing a column with a literal, and the inserted or
+        updated `values`, are turned into bound parameters, so statements of
+        the same shape are built once and reuse their memoized SQLAlchemy cache
+        key. Returns the statement and the parameters to execute it with.
+        """
+        values = values or {}
+        if any(isinstance(value, ClauseElement) for value in values.values()):
+            # SQL expressions such as `Table.column + 1` cannot be bound, build
+            # the statement with them inlined and leave it out of the cache
+            self.cache_misses += 1
+            return self._build(kind, table, where, values, order_by, limit), {}
+        bound = {column: bindparam(f"_v_{column}") for column in values}
+        params = {f"_v_{column}": value for column, value in values.items()}
+        shape: list[tuple] = []
+        for index, clause in enumerate(where):
+            if not (
+                isinstance(clause, BinaryExpression)
+                and clause.operator in CACHEABLE_OPERATORS
+                and isinstance(clause.left, Column)
+                and isinstance(clause.right, BindParameter)
+            ):
+                self.cache_misses += 1
+                return (
+                    self._build(kind, table, where, bound, order_by, limit),
+                    params,
+                )
+            params[f"_w{index}"] = clause.right.effective_value
+            shape.append(
+                (
+                    clause.left.table.name,
+                    clause.left.key,
+                    clause.operator,
+                    clause.right.expanding,
+                )
+            )
+        key = (
+            kind,
+            table,
+            tuple(shape),
+            tuple(values),
+            None if order_by is None else str(order_by),
+            limit,
+        )
+        if (stmt := self.statements.get(key)) is not None:
+            self.statements.move_to_end(key)
+            self.cache_hits += 1
+            return stmt, params
+        self.cache_misses += 1
+        where = tuple(
+            clause.operator(
+                clause.left, bindparam(f"_w{index}", expanding=clause.right.expanding)
+            )
+            for index, clause in enumerate(where)
+        )
+        stmt = self._build(kind, table, where, bound, order_by, limit)
+        self.statements[key] = stmt
+        if len(self.statements) > self.statement_cache_size:
+            self.statements.popitem(last=False)
+        return stmt, params
+
+    @staticmethod
+    def _build(
+        kind: str, table, where: Sequence, values: dict[str, Any], order_by, limit
+    ) -> Executable:
+        match kind:
+            case "select":
+                sql = select(table).where(*where)
+                if order_by is not None:
+                    sql = sql.order_by(order_by)
+                return sql if limit is None else sql.limit(limit)
+            case "insert":
+                return insert(table.__table__).values(values)
+            case "update":
+                return update(table.__table__).where(*where).values(values)
+            case "delete":
+                return delete(table.__table__).where(*where)
+        raise ValueError(f"Unknown statement kind: {kind!r}")
+
+    def cache_info(self) -> dict[str, int]:
+        """Return the hit and miss counters of the statement cache"""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self.statements),
+        }
+
     async def execute(self, sql: Executable, **kwargs) -> Result:
         async with self.session() as session:
             try:
@@ -45,71 +300,416 @@ class DatabaseEngine:
                 await session.rollback()
                 raise e
 
-    async def all(self, table, *where):
-        return (await self.execute(select(table).where(*where))).all()
+    async def query(self, sql: Executable, **kwargs) -> Result:
+        async with self.read_session() as session:
+            return await session.execute(sql, **kwargs)
+
+    async def all(self, table, *where, order_by=None):
+        sql, params = self.prepare("select", table, *where, order_by=order_by)
+        return (await self.query(sql, params=params)).all()
 
-    async def first(self, table, *where):
-        return (await self.execute(select(table).where(*where))).first()
+    async def first(self, table, *where, order_by=None):
+        sql, params = self.prepare("select", table, *where, order_by=order_by)
+        return (await self.query(sql, params=params)).first()
 
     @asynccontextmanager
     async def scalar(self, table: type[_T], *where) -> AsyncGenerator[_T, None]:
-        async with self.session() as session:
-            yield (await session.execute(select(table).where(*where))).scalar()  # type: ignore
+        sql, params = self.prepare("select", table, *where)
+        async with self.read_session() as session:
+            yield (await session.execute(sql, params=params)).scalar()  # type: ignore
 
     async def fetchone(self, table, *where):
-        return (await self.execute(select(table).where(*where))).fetchone()
+        sql, params = self.prepare("select", table, *where)
+        return (await self.query(sql, params=params)).fetchone()
 
     async def fetchmany(self, table, *where, size: int | None):
-        return (await self.execute(select(table).where(*where))).fetchmany(size)
+        sql = select(table).where(*where)
+        if size is not None:
+            sql = sql.limit(size)
+        return (await self.query(sql)).fetchmany(size)
+
+    async def stream(
+        self, table: type[_T], *where, batch_size: int = 1000
+    ) -> AsyncGenerator[_T, None]:
+        """
+        Iterate over matching rows using a server-side cursor.
+
+        Rows are fetched `batch_size` at a time; a read connection is held until
+        the iteration finishes.
+        """
+        async with self.read_session() as session:
+            result = await session.stream(
+                select(table).where(*where).execution_options(yield_per=batch_size)
+            )
+            async for row in result.scalars():
+                yield row
+
+    async def page(
+        self,
+        table: type[_T],
+        *where,
+        after: Any = None,
+        size: int = 100,
+        key=None,
+        descending: bool = False,
+    ) -> list[_T]:
+        """Fetch one keyset-paginated page ordered by `key`, the primary key by default"""
+        if key is None:
+            (key,) = table.__table__.primary_key.columns  # type: ignore
+        sql = select(table).where(*where)
+        if after is not None:
+            sql = sql.where(key < after if descending else key > after)
+        sql = sql.order_by(key.desc() if descending else key).limit(size)
+        return list((await self.query(sql)).scalars().all())
+
+    async def paginate(
+        self, table: type[_T], *where, batch_size: int = 1000, key=None
+    ) -> AsyncGenerator[list[_T], None]:
+        """
+        Iterate over matching rows in keyset-paginated batches.
+
+        Unlike `stream`, no connection is held between batches, which suits long
+        scans that write in between.
+        """
+        if key is None:
+            (key,) = table.__table__.primary_key.columns  # type: ignore
+        after = None
+        # Held between batches too, so that the registry does not dispose of us
+        self.users += 1
+        try:
+            while rows := await self.page(
+                table, *where, after=after, size=batch_size, key=key
+            ):
+                yield rows
+                if len(rows) < batch_size:
+                    return
+                after = getattr(rows[-1], key.key)
+        finally:
+            self.users -= 1
 
     async def insert(self, table, **values):
-        return await self.execute(insert(table).values(**values))
+        sql, params = self.prepare("insert", table, values=values)
+        return await self.execute(sql, params=params)
 
     async def update(self, table, *where, **values):
-        return await self.execute(update(table).where(*where).values(**values))
+        sql, params = self.prepare("update", table, *where, values=values)
+        return await self.execute(sql, params=params)
+
+    async def scalar_eager(self, table, *where, order_by=None):
+        sql, params = self.prepare("select", table, *where, order_by=order_by)
+        return (await self.query(sql, params=params)).scalar()
+
+    async def _unique_keys(self, table) -> set[frozenset[str]]:
+        name = table.__tablename__
+        if name not in self.unique_keys:
+
+            def _inspect(sync_conn) -> set[frozenset[str]]:
+                inspector = inspect(sync_conn)
+                if not inspector.has_table(name):
+                    return set()
+                keys = {
+                    frozenset(index["column_names"])
+                    for index in inspector.get_indexes(name)
+                    if index["unique"]
+                }
+                keys |= {
+                    frozenset(constraint["column_names"])
+                    for constraint in inspector.get_unique_constraints(name)
+                }
+                if primary := inspector.get_pk_constraint(name)["constrained_columns"]:
+                    keys.add(frozenset(primary))
+                return keys
 
-    async def scalar_eager(self, table, *where):
-        return (await self.execute(select(table).where(*where))).scalar()
+            if (conn := self._bound.get()) is not None:
+                keys = await conn.run_sync(_inspect)
+            else:
+                async with self.engine.connect() as conn:
+                    keys = await conn.run_sync(_inspect)
+            if not keys:
+                # The table does not exist (yet), look again next time
+                return keys
+            self.unique_keys[name] = keys
+        return self.unique_keys[name]
+
+    async def upsert_statement(
+        self, table, *where, ignore: bool = False, **values
+    ) -> Executable | None:
+        """
+        Build a dialect-native `INSERT ... ON CONFLICT` statement.
+
+        Only applies when every where clause is an equality on a column whose
+        value is also being inserted, and those columns form a unique key in
+        the database; returns None otherwise, and when a value is a SQL
+        expression, which could only be evaluated against an existing row.
+        """
+        if self.engine.dialect.name not in ("sqlite", "mysql") or any(
+            isinstance(value, ClauseElement) for value in values.values()
+        ):
+            return None
+        columns: list[str] = []
+        for clause in where:
+            if not (
+                isinstance(clause, BinaryExpression)
+                and clause.operator is operators.eq
+                and isinstance(clause.left, ColumnClause)
+                and isinstance(clause.right, BindParameter)
+                and clause.left.key in values
+                and values[clause.left.key] == clause.right.value
+            ):
+                return None
+            columns.append(clause.left.key)
+        if frozenset(columns) not in await self._unique_keys(table):
+            return None
+        return self._native_upsert(table, columns, values, ignore).values(**values)
+
+    def _native_upsert(
+        self, table, keys: Sequence[str], columns: Iterable[str], ignore: bool
+    ):
+        updates = [column for column in columns if column not in keys]
+        if self.engine.dialect.name == "sqlite":
+            stmt = sqlite.insert(table)
+            if ignore or not updates:
+                return stmt.on_conflict_do_nothing(index_elements=keys)
+            return stmt.on_conflict_do_update(
+                index_elements=keys, set_={k: stmt.excluded[k] for k in updates}
+            )
+        stmt = mysql.insert(table)
+        if ignore or not updates:
+            return stmt.prefix_with("IGNORE")
+        return stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in updates})
 
     async def insert_or_update(self, table, *where, **values):
-        if not await self.scalar_eager(table, *where):
-            return await self.execute(insert(table).values(**values))
-        return await self.execute(update(table).where(*where).values(**values))
+        if (stmt := await self.upsert_statement(table, *where, **values)) is not None:
+            return await self.execute(stmt)
+        async with self.transaction() as tx:
+            return await tx.upsert(table, *where, **values)
 
     async def insert_or_ignore(self, table, *where, **values):
-        if not await self.scalar_eager(table, *where):
-            return await self.execute(insert(table).values(**values))
+        if (
+            stmt := await self.upsert_statement(table, *where, ignore=True, **values)
+        ) is not None:
+            return await self.execute(stmt)
+        async with self.transaction() as tx:
+            return await tx.upsert(table, *where, ignore=True, **values)
+
+    @staticmethod
+    def _batches(
+        rows: Sequence[dict[str, Any]], chunk_size: int
+    ) -> Iterator[tuple[tuple[str, ...], list[dict[str, Any]]]]:
+        for start in range(0, len(rows), chunk_size):
+            groups: dict[tuple[str, ...], list[dict[str, Any]]] = {}
+            for row in rows[start : start + chunk_size]:
+                groups.setdefault(tuple(row), []).append(row)
+            yield from groups.items()
+
+    async def insert_many(
+        self, table, rows: Sequence[dict[str, Any]], chunk_size: int = 500
+    ):
+        """Insert rows in one transaction, `chunk_size` rows per executemany"""
+        async with self.begin() as conn:
+            for _, group in self._batches(rows, chunk_size):
+                await conn.execute(insert(table), group)
+
+    async def upsert_many(
+        self,
+        table,
+        rows: Sequence[dict[str, Any]],
+        keys: Sequence[str],
+        chunk_size: int = 500,
+        ignore: bool = False,
+    ):
+        """
+        Insert rows, updating (or ignoring) those whose `keys` already exist.
+
+        Runs in one transaction; uses executemany with a native upsert when
+        `keys` form a unique key in the database, and falls back to per-row
+        lookups otherwise.
+        """
+        native = self.engine.dialect.name in ("sqlite", "mysql") and frozenset(
+            keys
+        ) in await self._unique_keys(table)
+        async with self.begin() as conn:
+            for columns, group in self._batches(rows, chunk_size):
+                if native:
+                    await conn.execute(
+                        self._native_upsert(table, keys, columns, ignore), group
+                    )
+                    continue
+                for row in group:
+                    where = [getattr(table, k) == row[k] for k in keys]
+                    if (await conn.execute(select(table).where(*where))).first():
+                        if not ignore:
+                            await conn.execute(
+                                update(table).where(*where).values(**row)
+                            )
+                    else:
+                        await conn.execute(insert(table).values(**row))
+
+    async def update_many(
+        self,
+        table,
+        rows: Sequence[dict[str, Any]],
+        keys: Sequence[str],
+        chunk_size: int = 500,
+    ):
+        """Update rows matched by `keys` in one transaction using executemany"""
+        async with self.begin() as conn:
+            for columns, group in self._batches(rows, chunk_size):
+                updates = [column for column in columns if column not in keys]
+                sql = (
+                    update(table)
+                    .where(*(getattr(table, k) == bindparam(f"_{k}") for k in keys))
+                    .values({column: bindparam(column) for column in updates})
+                )
+                await conn.execute(
+                    sql,
+                    [
+                        {
+                            **{f"_{k}": row[k] for k in keys},
+                            **{column: row[column] for column in updates},
+                        }
+                        for row in group
+                    ],
+                )
 
     async def delete(self, table, *where):
-        return await self.execute(delete(table).where(*where))
+        sql, params = self.prepare("delete", table, *where)
+        return await self.execute(sql, params=params)
 
     async def create(self, table):
-        async with self.lock():
-            async with self.engine.begin() as conn:
-                if await conn.run_sync(
-                    lambda sync_conn: inspect(sync_conn).has_table(table.__tablename__)
-                ):
-                    logger.debug(
-                        f"[DatabaseEngine] Table {table.__tablename__!r} already exists, skipping..."
+        async with self.connection() as conn:
+            exists = await conn.run_sync(
+                lambda sync_conn: inspect(sync_conn).has_table(table.__tablename__)
+            )
+            if not exists:
+                await conn.run_sync(table.__table__.create)
+        self.unique_keys.pop(table.__tablename__, None)
+        if exists:
+            logger.debug(
+                f"[DatabaseEngine] Table {table.__tablename__!r} already exists, skipping..."
+            )
+            await self.create_columns(table)
+            await self.create_indexes(table)
+
+    async def create_columns(self, table):
+        """Add columns declared on an existing table but missing in the database"""
+        async with self.connection() as conn:
+            existing = await conn.run_sync(
+                lambda sync_conn: {
+                    column["name"]
+                    for column in inspect(sync_conn).get_columns(table.__tablename__)
+                }
+            )
+            for column in table.__table__.columns:
+                if column.name in existing:
+                    continue
+                name = self.engine.dialect.identifier_preparer.format_table(
+                    table.__table__
+                )
+                ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+                try:
+                    await conn.exec_driver_sql(f"ALTER TABLE {name} ADD COLUMN {ddl}")
+                    logger.success(
+                        f"[DatabaseEngine] Added column {column.name!r} "
+                        f"to {table.__tablename__!r}"
+                    )
+                except OperationalError as err:
+                    logger.warning(
+                        f"[DatabaseEngine] Failed to add column {column.name!r} "
+                        f"to {table.__tablename__!r}: {err}"
                     )
-                else:
-                    await conn.run_sync(table.__table__.create)
+
+    async def create_indexes(self, table):
+        """Create indexes declared on an existing table but missing in the database"""
+        async with self.connection() as conn:
+            existing = await conn.run_sync(
+                lambda sync_conn: {
+                    index["name"]
+                    for index in inspect(sync_conn).get_indexes(table.__tablename__)
+                }
+            )
+            for index in table.__table__.indexes:
+                if index.name in existing:
+                    continue
+                try:
+                    await conn.run_sync(index.create)
+                    logger.success(
+                        f"[DatabaseEngine] Created index {index.name!r} "
+                        f"on {table.__tablename__!r}"
+                    )
+                except (IntegrityError, OperationalError) as err:
+                    logger.warning(
+                        f"[DatabaseEngine] Failed to create index {index.name!r} "
+                        f"on {table.__tablename__!r}: {err}"
+                    )
+        self.unique_keys.pop(table.__tablename__, None)
 
     async def drop(self, table):
-        async with self.lock():
-            async with self.engine.begin() as conn:
-                await conn.run_sync(table.__table__.drop)
+        async with self.connection() as conn:
+            await conn.run_sync(table.__table__.drop)
+        self.unique_keys.pop(table.__tablename__, None)
 
     async def create_all(self):
-        async with self.lock():
-            async with self.engine.begin() as conn:
-                await conn.run_sync(Base.metadata.create_all)
+        async with self.connection() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.unique_keys.clear()
 
     async def drop_all(self):
-        async with self.lock():
-            async with self.engine.begin() as conn:
-                await conn.run_sync(Base.metadata.drop_all)
+        async with self.connection() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        self.unique_keys.clear()
 
     async def close(self):
         async with self.lock():
             await self.engine.dispose()
+
+
+class Transaction:
+    """Helpers of a unit of work opened by `DatabaseEngine.transaction()`"""
+
+    engine: DatabaseEngine
+    session: AsyncSession
+
+    def __init__(self, engine: DatabaseEngine, session: AsyncSession):
+        self.engine = engine
+        self.session = session
+
+    async def execute(self, sql: Executable, **kwargs) -> Result:
+        return await self.session.execute(sql, **kwargs)
+
+    async def all(self, table, *where, order_by=None):
+        sql, params = self.engine.prepare("select", table, *where, order_by=order_by)
+        return (await self.execute(sql, params=params)).all()
+
+    async def first(self, table, *where, order_by=None):
+        sql, params = self.engine.prepare("select", table, *where, order_by=order_by)
+        return (await self.execute(sql, params=params)).first()
+
+    async def scalar(self, table: type[_T], *where, order_by=None) -> _T | None:
+        sql, params = self.engine.prepare("select", table, *where, order_by=order_by)
+        return (await self.execute(sql, params=params)).scalar()
+
+    async def insert(self, table, **values):
+        sql, params = self.engine.prepare("insert", table, values=values)
+        return await self.execute(sql, params=params)
+
+    async def update(self, table, *where, **values):
+        sql, params = self.engine.prepare("update", table, *where, values=values)
+        return await self.execute(sql, params=params)
+
+    async def upsert(self, table, *where, ignore: bool = False, **values):
+        """Insert a row, or update (or ignore) the rows matching `where`"""
+        if (
+            stmt := await self.engine.upsert_statement(
+                table, *where, ignore=ignore, **values
+            )
+        ) is not None:
+            return await self.execute(stmt)
+        if await self.first(table, *where) is None:
+            return await self.insert(table, **values)
+        if not ignore:
+            return await self.update(table, *where, **values)
+
+    async def delete(self, table, *where):
+        sql, params = self.engine.prepare("delete", table, *where)
+        return await self.execute(sql, params=params)
@@ -0,0 +1,115 @@
+import asyncio
+from asyncio import Lock, Task, TimerHandle
+from typing import Any
+
+from avilla.core import Selector
+from loguru import logger
+
+from mephisto.library.util.orm.registry import DatabaseRegistry
+
+
+class WriteBuffer:
+    """
+    A per-database write-behind buffer.
+
+    Rows are merged by their key columns and flushed in a single transaction
+    once a database has collected `size` rows, or `interval` seconds after
+    its first pending row, whichever comes first. Rows sharing a table and
+    key columns are written with `DatabaseEngine.upsert_many`.
+    """
+
+    registry: DatabaseRegistry
+    size: int
+    interval: float
+    pending: dict[str, dict[tuple, tuple[Any, tuple[str, ...], dict[str, Any]]]]
+
+    def __init__(
+        self, registry: DatabaseRegistry, size: int = 100, interval: float = 1.0
+    ):
+        self.registry = registry
+        self.size = size
+        self.interval = interval
+        self.pending = {}
+        self._targets: dict[str, Selector | str] = {}
+        self._timers: dict[str, TimerHandle] = {}
+        self._locks: dict[str, Lock] = {}
+        self._tasks: set[Task] = set()
+
+    @staticmethod
+    def _key(selector: Selector | str) -> str:
+        return selector.display if isinstance(selector, Selector) else selector
+
+    def put(self, selector: Selector | str, table, keys: tuple[str, ...], /, **values):
+        key = self._key(selector)
+        rows = self.pending.setdefault(key, {})
+        self._targets[key] = selector
+        identity = (table, *(values[k] for k in keys))
+        if identity in rows:
+            rows[identity][2].update(values)
+        else:
+            rows[identity] = (table, keys, values)
+        if len(rows) >= self.size:
+            self._schedule(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(
+                self.interval, self._schedule, key
+            )
+
+    def _schedule(self, key: str):
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        task = asyncio.create_task(self.flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, selector: Selector | str | None = None):
+        if selector is None:
+            for key in list(self.pending):
+                await self.flush(key)
+            return
+        key = self._key(selector)
+        async with self._locks.setdefault(key, Lock()):
+            if timer := self._timers.pop(key, None):
+                timer.cancel()
+            if not (rows := self.pending.pop(key, None)):
+                return
+            target = self._targets.pop(key, key)
+            try:
+                engine = await self.registry.create(target)
+                groups: dict[tuple, list[dict[str, Any]]] = {}
+                for table, keys, values in rows.values():
+                    groups.setdefault((table, keys), []).append(values)
+                async with engine.begin():
+                    for (table, keys), group in groups.items():
+                        await engine.upsert_many(table, group, keys)
+                logger.debug(f"[WriteBuffer] Flushed {len(rows)} rows to {key}")
+            except Exception as err:
+                logger.exception(err)
+                logger.error(
+                    f"[WriteBuffer] Failed to flush {len(rows)} rows to {key}, "
+                    f"retrying in {self.interval}s"
+                )
+                self._restore(key, target, rows)
+
+    def _restore(self, key: str, target: Selector | str, rows: dict):
+        """Put rows back in front of those pending since, and retry later"""
+        pending = self.pending.setdefault(key, {})
+        for identity, (table, keys, values) in rows.items():
+            if identity in pending:
+                values.update(pending[identity][2])
+            pending[identity] = (table, keys, values)
+        self._targets.setdefault(key, target)
+        if key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(
+                self.interval, self._schedule, key
+            )
+
+    async def close(self):
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if lost := sum(len(rows) for rows in self.pending.values()):
+            logger.error(f"[WriteBuffer] Dropped {lost} rows that could not be flushed")
@@ -0,0 +1,182 @@
+import asyncio
+from itertools import groupby
+from pathlib import Path
+from typing import AsyncGenerator, Callable, Final
+
+from avilla.core import Selector
+from loguru import logger
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import OperationalError
+
+from mephisto.library.util.orm.base import DatabaseEngine
+from mephisto.library.util.orm.registry import (
+    DATABASE_PATH,
+    MYSQL_KEY,
+    SHARD_PREFIX,
+    SQLITE_LINK_PATTERN,
+    DatabaseRegistry,
+)
+from mephisto.library.util.orm.table import RecordTable
+
+REENCODE_MARKER: Final[str] = "mephisto.record.reencode"
+
+
+def scene_database_files(root: Path = DATABASE_PATH) -> list[Path]:
+    """List per-scene database files, excluding the main database and shards"""
+    return [
+        path
+        for path in root.rglob("*.db")
+        if path != root / "main.db" and (root / SHARD_PREFIX) not in path.parents
+    ]
+
+
+async def _peek_scene(path: Path) -> str | None:
+    source = DatabaseEngine(SQLITE_LINK_PATTERN.format(path=path))
+    try:
+        return (await source.query(select(RecordTable.scene).limit(1))).scalar()
+    except OperationalError:
+        return None
+    finally:
+        await source.close()
+
+
+async def record_databases(
+    registry: DatabaseRegistry, root: Path = DATABASE_PATH
+) -> AsyncGenerator[tuple[str, DatabaseEngine], None]:
+    """
+    Open every database holding records under the configured layout.
+
+    Databases are opened through the registry, so that writes share its locks;
+    per-scene files are matched to their scene by one of their records.
+    """
+    match registry.layout():
+        case "mysql":
+            yield MYSQL_KEY, await registry.create(MYSQL_KEY)
+        case "sharded":
+            for path in sorted((root / SHARD_PREFIX).glob("*.db")):
+                key = path.relative_to(root).with_suffix("").as_posix()
+                yield key, await registry.create(key)
+        case _:
+            for path in scene_database_files(root):
+                if (scene := await _peek_scene(path)) is None:
+                    continue
+                selector = Selector.from_follows(scene)
+                expected = registry.selector_to_path(selector)
+                if expected.relative_to(DATABASE_PATH) != path.relative_to(root):
+                    logger.warning(
+                        f"[Migrate] Skipped {path}: holds records of {scene}"
+                    )
+                    continue
+                yield scene, await registry.create(selector)
+
+
+async def import_scene_databases(
+    registry: DatabaseRegistry, root: Path = DATABASE_PATH, batch_size: int = 1000
+) -> int:
+    """
+    Import records from per-scene database files into the configured layout.
+
+    Source files are left untouched, and records already present in the target
+    are skipped, so the import can safely be run again.
+
+    Returns:
+        Number of records read from the source files
+    """
+    if registry.layout() == "scene":
+        logger.warning("[Migrate] Database layout is 'scene', nothing to import")
+        return 0
+    columns = [column.key for column in RecordTable.__table__.columns]
+    columns.remove("id")
+    imported = 0
+    for path in scene_database_files(root):
+        source = DatabaseEngine(SQLITE_LINK_PATTERN.format(path=path))
+        try:
+            async for rows in source.paginate(RecordTable, batch_size=batch_size):
+                for scene, group in groupby(rows, key=lambda row: str(row.scene)):
+                    target = await registry.create(Selector.from_follows(scene))
+                    await target.upsert_many(
+                        RecordTable,
+                        [
+                            {column: getattr(row, column) for column in columns}
+                            for row in group
+                        ],
+                        ("selector",),
+                        chunk_size=batch_size,
+                        ignore=True,
+                    )
+                imported += len(rows)
+            logger.success(f"[Migrate] Imported records from {path}")
+        except OperationalError as err:
+            logger.warning(f"[Migrate] Skipped {path}: {err}")
+        finally:
+            await source.close()
+    return imported
+
+
+async def _reencode(
+    engine: DatabaseEngine,
+    transcode: Callable[[str], str],
+    where: tuple,
+    batch_size: int,
+    pause: float,
+) -> int:
+    sql = (
+        update(RecordTable)
+        .where(
+            RecordTable.id == bindparam("_id"),
+            RecordTable.content == bindparam("_content"),
+        )
+        .values(content=bindparam("content"))
+    )
+    rewritten = failed = 0
+    async for rows in engine.paginate(
+        RecordTable, RecordTable.content.is_not(None), *where, batch_size=batch_size
+    ):
+        params = []
+        for row in rows:
+            try:
+                content = transcode(str(row.content))
+            except Exception as err:
+                logger.debug(f"[Migrate] Failed to re-encode record {row.id}: {err}")
+                failed += 1
+                continue
+            if content != row.content:
+                params.append(
+                    {"_id": row.id, "_content": row.content, "content": content}
+                )
+        if params:
+            async with engine.begin() as conn:
+                await conn.execute(sql, params)
+            rewritten += len(params)
+        await asyncio.sleep(pause)
+    if failed:
+        logger.warning(f"[Migrate] {failed} records could not be re-encoded")
+    return rewritten
+
+
+async def reencode_records(
+    registry: DatabaseRegistry,
+    transcode: Callable[[str], str],
+    *where,
+    root: Path = DATABASE_PATH,
+    batch_size: int = 500,
+    pause: float = 0.0,
+) -> int:
+    """
+    Rewrite the content of matching records in every database with `transcode`.
+
+    Databases are opened through the registry, and a record is only rewritten
+    if its content did not change in the meantime, so this can run alongside
+    recording and be interrupted at any point. Records failing to transcode are
+    left as-is. `pause` seconds are slept between batches.
+
+    Returns:
+        Number of rewritten records
+    """
+    rewritten = 0
+    async for name, engine in record_databases(registry, root):
+        try:
+            rewritten += await _reencode(engine, transcode, where, batch_size, pause)
+        except OperationalError as err:
+            logger.warning(f"[Migrate] Skipped {name}: {err}")
+    return rewritten
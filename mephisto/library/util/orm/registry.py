@@ -1,66 +1,340 @@
 import asyncio
-from asyncio import Semaphore
+import inspect
+import time
+import zlib
+from asyncio import Semaphore, Task
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
 from pathlib import Path
 from typing import Any, Callable, Coroutine, Final
 
 from avilla.core import Selector
+from kayaku import create
 from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
+from mephisto.library.model.config import MephistoConfig
 from mephisto.library.util.orm.base import DatabaseEngine
+from mephisto.library.util.orm.table import SchemaTable
 from mephisto.shared import DATA_ROOT
 
 SQLITE_LINK_PATTERN: Final[str] = "sqlite+aiosqlite:///{path}"
+SQLITE_PROFILES: Final[dict[str, dict[str, Any]]] = {
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -8000,
+        "mmap_size": 67108864,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -32000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 10000,
+    },
+}
 DATABASE_PATH: Final[Path] = DATA_ROOT / "database"
+DATABASE_LAYOUTS: Final[tuple[str, ...]] = ("scene", "sharded", "mysql")
+SHARD_PREFIX: Final[str] = "shard"
+MYSQL_KEY: Final[str] = "@mysql"
 
 
 class DatabaseRegistry:
-    databases: dict[str, DatabaseEngine]
+    databases: OrderedDict[str, DatabaseEngine]
     hooks: dict[str, list[Callable[[DatabaseEngine], Coroutine[None, None, None]]]]
+    versions: dict[str, int]
+    accessed: dict[str, float]
+    initialized: set[str]
+    pinned: set[str]
 
     def __init__(self):
-        self.databases = {}
+        self.databases = OrderedDict()
         self.hooks = {}
+        self.versions = {}
+        self.accessed = {}
+        self.initialized = set()
+        self.pinned = set()
+        self._opening: dict[str, Task[DatabaseEngine]] = {}
 
-    def __getitem__(self, selector: Selector) -> DatabaseEngine:
-        if selector.display in self.databases:
-            return self.databases[selector.display]
-        return asyncio.run(self.create(selector))
+    def __getitem__(self, selector: Selector | str) -> "DatabaseHandle":
+        return DatabaseHandle(self, selector)
+
+    @staticmethod
+    def layout() -> str:
+        cfg = create(MephistoConfig).advanced.database
+        if cfg.layout in DATABASE_LAYOUTS:
+            return cfg.layout
+        logger.warning(
+            f"[DatabaseRegistry] Unknown database layout {cfg.layout!r}, "
+            "falling back to 'scene'"
+        )
+        return "scene"
+
+    def resolve(self, selector: Selector | str) -> str:
+        """Map a scene to the key of the database storing it under the current layout"""
+        if not isinstance(selector, Selector):
+            return selector
+        match self.layout():
+            case "sharded":
+                shards = create(MephistoConfig).advanced.database.shards
+                shard = zlib.crc32(selector.display.encode()) % shards
+                return f"{SHARD_PREFIX}/{shard:03d}"
+            case "mysql":
+                return MYSQL_KEY
+            case _:
+                return selector.display
+
+    @staticmethod
+    def sqlite_pragmas() -> dict[str, Any]:
+        cfg = create(MephistoConfig).advanced.database
+        if cfg.profile in SQLITE_PROFILES:
+            return SQLITE_PROFILES[cfg.profile]
+        if cfg.profile != "custom":
+            logger.warning(
+                f"[DatabaseRegistry] Unknown SQLite profile {cfg.profile!r}, "
+                "falling back to 'balanced'"
+            )
+            return SQLITE_PROFILES["balanced"]
+        return {
+            "journal_mode": cfg.journal_mode,
+            "synchronous": cfg.synchronous,
+            "cache_size": cfg.cache_size,
+            "mmap_size": cfg.mmap_size,
+            "temp_store": cfg.temp_store,
+            "busy_timeout": cfg.busy_timeout,
+        }
 
     @staticmethod
     def selector_to_path(selector: Selector) -> Path:
         return Path(DATABASE_PATH / f"{'/'.join(selector.pattern.values())}.db")
 
-    async def create(self, selector: Selector | str) -> DatabaseEngine:
-        key = selector.display if isinstance(selector, Selector) else selector
+    async def create(
+        self, selector: Selector | str, *, pin: bool = False
+    ) -> DatabaseEngine:
+        key = self.resolve(selector)
+        if pin:
+            self.pinned.add(key)
         if key in self.databases:
+            self.databases.move_to_end(key)
+            self.accessed[key] = time.monotonic()
             return self.databases[key]
+        if key not in self._opening:
+            self._opening[key] = asyncio.create_task(self._open(selector, key))
+        return await asyncio.shield(self._opening[key])
+
+    def _engine(self, selector: Selector | str, key: str) -> DatabaseEngine:
+        if key == MYSQL_KEY:
+            return DatabaseEngine(
+                create(MephistoConfig).advanced.database.mysql_url, pool_recycle=3600
+            )
         path = (
             self.selector_to_path(selector)
-            if isinstance(selector, Selector)
+            if isinstance(selector, Selector) and key == selector.display
             else Path(DATABASE_PATH / f"{key}.db")
         )
         path.parent.mkdir(parents=True, exist_ok=True)
-        logger.debug(f"[DatabaseRegistry] Creating database: {key}")
-        self.databases[key] = DatabaseEngine(
-            SQLITE_LINK_PATTERN.format(path=path), Semaphore(1)
+        pragmas = self.sqlite_pragmas()
+        readers = create(MephistoConfig).advanced.database.readers
+        return DatabaseEngine(
+            SQLITE_LINK_PATTERN.format(path=path),
+            Semaphore(1),
+            (
+                Semaphore(readers)
+                if str(pragmas["journal_mode"]).upper() == "WAL"
+                else None
+            ),
+            pragmas,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=readers + 1,
+        )
+
+    async def _open(self, selector: Selector | str, key: str) -> DatabaseEngine:
+        try:
+            logger.debug(f"[DatabaseRegistry] Creating database: {key}")
+            database = self._engine(selector, key)
+            if key not in self.initialized:
+                await self._run_hooks(database)
+                self.initialized.add(key)
+            self.databases[key] = database
+            self.accessed[key] = time.monotonic()
+            await self._evict()
+            return database
+        finally:
+            self._opening.pop(key, None)
+
+    async def dispose(self, key: str) -> bool:
+        """
+        Close a database unless an operation is still running on it.
+
+        Returns:
+            Whether the database was closed
+        """
+        if (database := self.databases.get(key)) is None or database.in_use:
+            return False
+        del self.databases[key]
+        self.accessed.pop(key, None)
+        logger.debug(f"[DatabaseRegistry] Disposing database: {key}")
+        await database.close()
+        return True
+
+    async def _evict(self):
+        max_open = create(MephistoConfig).advanced.database.max_open
+        excess = len(self.databases) - max_open
+        for key in [key for key in self.databases if key not in self.pinned]:
+            if excess <= 0:
+                return
+            if await self.dispose(key):
+                excess -= 1
+
+    async def sweep(self):
+        """Dispose databases that have not been accessed within the idle timeout"""
+        idle_timeout = create(MephistoConfig).advanced.database.idle_timeout
+        if idle_timeout <= 0:
+            return
+        deadline = time.monotonic() - idle_timeout
+        for key in [key for key, at in self.accessed.items() if at < deadline]:
+            if key not in self.pinned:
+                await self.dispose(key)
+
+    @staticmethod
+    async def _applied_versions(database: DatabaseEngine) -> dict[str, int]:
+        try:
+            result = await database.query(select(SchemaTable.hook, SchemaTable.version))
+        except (OperationalError, ProgrammingError):
+            return {}
+        return {str(hook): int(version) for hook, version in result.all()}
+
+    async def _mark_applied(self, database: DatabaseEngine, name: str):
+        await database.insert_or_update(
+            SchemaTable,
+            SchemaTable.hook == name,
+            hook=name,
+            version=self.versions[name],
+            apply_time=datetime.now(),
         )
-        await self._run_hooks(self.databases[key])
-        return self.databases[key]
 
     async def _run_hooks(self, database: DatabaseEngine):
-        for module in self.hooks:
-            for hook in self.hooks[module]:
-                try:
-                    logger.debug(
-                        f"[DatabaseRegistry] Running hook: {module}.{hook.__name__}"
-                    )
+        applied = await self._applied_versions(database)
+        pending = [
+            (name, hook)
+            for module in self.hooks
+            for hook in self.hooks[module]
+            if applied.get(name := f"{module}.{hook.__name__}", 0) < self.versions[name]
+        ]
+        if not pending:
+            logger.debug("[DatabaseRegistry] Schema is up to date, skipping hooks")
+            return
+        try:
+            async with database.begin():
+                await database.create(SchemaTable)
+                for name, hook in pending:
+                    logger.debug(f"[DatabaseRegistry] Running hook: {name}")
                     await hook(database)
-                except Exception as err:
-                    logger.exception(err)
-                    logger.error(
-                        f"[DatabaseRegistry] Hook {module}.{hook.__name__} failed"
-                    )
-
-    def hook(self, func: Callable[[DatabaseEngine], Coroutine[Any, Any, None]]):
-        self.hooks.setdefault(func.__module__, []).append(func)  # type: ignore
-        logger.debug(f"[DatabaseRegistry] Registered hook: {func.__module__}.{func.__name__}")  # type: ignore
+                    await self._mark_applied(database, name)
+            return
+        except Exception as err:
+            logger.exception(err)
+            logger.warning(
+                "[DatabaseRegistry] Failed to apply pending hooks in one transaction, "
+                "retrying one by one"
+            )
+        for name, hook in pending:
+            try:
+                logger.debug(f"[DatabaseRegistry] Running hook: {name}")
+                await database.create(SchemaTable)
+                await hook(database)
+                await self._mark_applied(database, name)
+            except Exception as err:
+                logger.exception(err)
+                logger.error(f"[DatabaseRegistry] Hook {name} failed")
+
+    def hook(
+        self,
+        func: Callable[[DatabaseEngine], Coroutine[Any, Any, None]] | None = None,
+        *,
+        version: int = 1,
+    ):
+        """
+        Register a hook run on every newly opened database.
+
+        A hook only runs again on a database once its `version` is raised, so bump
+        the version whenever the schema it creates changes.
+        """
+
+        def wrapper(func: Callable[[DatabaseEngine], Coroutine[Any, Any, None]]):
+            name = f"{func.__module__}.{func.__name__}"  # type: ignore
+            self.hooks.setdefault(func.__module__, []).append(func)  # type: ignore
+            self.versions[name] = version
+            logger.debug(f"[DatabaseRegistry] Registered hook: {name} (v{version})")
+            return func
+
+        return wrapper if func is None else wrapper(func)
+
+
+class DatabaseHandle:
+    """
+    A lazily-connecting handle to a database of a registry.
+
+    The handle exposes the coroutine, async iterator and async context manager
+    helpers of `DatabaseEngine`, opening the database on first awaited use.
+    Awaiting the handle itself returns the underlying engine.
+    """
+
+    registry: DatabaseRegistry
+    selector: Selector | str
+
+    def __init__(self, registry: DatabaseRegistry, selector: Selector | str):
+        self.registry = registry
+        self.selector = selector
+
+    async def get(self) -> DatabaseEngine:
+        return await self.registry.create(self.selector)
+
+    def __await__(self):
+        return self.get().__await__()
+
+    def __getattr__(self, name: str):
+        attr = getattr(DatabaseEngine, name, None)
+        if inspect.iscoroutinefunction(attr):
+
+            async def call(*args, **kwargs):
+                return await getattr(await self.get(), name)(*args, **kwargs)
+
+            return call
+        if inspect.isasyncgenfunction(attr):
+
+            async def iterate(*args, **kwargs):
+                async for item in getattr(await self.get(), name)(*args, **kwargs):
+                    yield item
+
+            return iterate
+        if inspect.isasyncgenfunction(getattr(attr, "__wrapped__", None)):
+
+            @asynccontextmanager
+            async def context(*args, **kwargs):
+                async with getattr(await self.get(), name)(*args, **kwargs) as value:
+                    yield value
+
+            return context
+        raise AttributeError(
+            f"{name!r} is not available on {self.__class__.__name__}, "
+            "await the handle to get the database engine"
+        )
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.registry.resolve(self.selector)}>"
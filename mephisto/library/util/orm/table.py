@@ -1,10 +1,14 @@
-from sqlalchemy import Boolean, Column, DateTime, Integer, String, Text
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, String, Text
 
 from mephisto.library.util.orm.base import Base
 
 
 class RecordTable(Base):
     __tablename__ = "record"
+    __table_args__ = (
+        Index("ix_record_message_id", "message_id"),
+        Index("ix_record_selector", "selector", unique=True),
+    )
 
     id = Column(Integer(), primary_key=True)
     message_id = Column(String(length=64))
@@ -27,11 +31,24 @@ class RecordTable(Base):
 
 class AttachmentTable(Base):
     __tablename__ = "attachment"
+    __table_args__ = (
+        Index("ix_attachment_digest", "digest", unique=True),
+        Index("ix_attachment_pre_key", "pre_key"),
+    )
 
     id = Column(Integer(), primary_key=True)
     pattern = Column(String(length=256))
     file_path = Column(Text())
 
+    digest = Column(String(length=64), nullable=True)
+    pre_key = Column(String(length=256), nullable=True)
+    size = Column(Integer(), nullable=True)
+    mime = Column(String(length=128), nullable=True)
+    refcount = Column(Integer(), default=0, server_default="0")
+    pack = Column(String(length=256), nullable=True)
+    create_time = Column(DateTime(timezone=True), nullable=True)
+    access_time = Column(DateTime(timezone=True), nullable=True)
+
     deleted = Column(Boolean(), default=False)
     delete_time = Column(DateTime(timezone=True), nullable=True)
 
@@ -49,6 +66,9 @@ class ConfigTable(Base):
 
 class StatisticsTable(Base):
     __tablename__ = "statistics"
+    __table_args__ = (
+        Index("ix_statistics_key", "scene", "client", "key", unique=True),
+    )
 
     id = Column(Integer(), primary_key=True)
     scene = Column(String(length=64))
@@ -75,6 +95,11 @@ class CacheTable(Base):
 
 class PermissionTable(Base):
     __tablename__ = "permission"
+    __table_args__ = (
+        Index(
+            "ix_permission_lookup", "scene", "client", "scope", "target", "expire_time"
+        ),
+    )
 
     id = Column(Integer(), primary_key=True)
     scene = Column(String(length=64))
@@ -86,3 +111,14 @@ class PermissionTable(Base):
     effective = Column(Boolean(), default=True)
     create_time = Column(DateTime(timezone=True), nullable=True)
     expire_time = Column(DateTime(timezone=True), nullable=True)
+
+
+class SchemaTable(Base):
+    __tablename__ = "schema_version"
+    __table_args__ = (Index("ix_schema_version_hook", "hook", unique=True),)
+
+    id = Column(Integer(), primary_key=True)
+    hook = Column(String(length=256))
+    version = Column(Integer())
+
+    apply_time = Column(DateTime(timezone=True), nullable=True)
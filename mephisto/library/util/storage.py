@@ -5,7 +5,7 @@ from datetime import datetime, timedelta
 from hashlib import sha256
 from io import BytesIO
 from pathlib import Path
-from typing import IO
+from typing import IO, AsyncGenerator
 from uuid import uuid4
 
 import filetype
@@ -241,3 +241,18 @@ async def download_file(
         .get(url, **kwargs) as res
     ):
         return await res.read()
+
+
+async def stream_file(
+    url: URL | str, session_name: str = "universal", chunk_size: int = 65536, **kwargs
+) -> AsyncGenerator[bytes, None]:
+    """Download a file in chunks of at most `chunk_size` bytes"""
+    async with (
+        it(Launart)
+        .get_component(SessionService)
+        .get(session_name)
+        .get(url, **kwargs) as res
+    ):
+        res.raise_for_status()
+        async for chunk in res.content.iter_chunked(chunk_size):
+            yield chunk